@@ -206,8 +206,7 @@ def parse_invoice_completo(xml_content: str) -> Optional[Tuple[FatturaCompleta,
         clean_xml = xml_content[xml_content.find('<?xml'):]
         it = ET.iterparse(io.StringIO(clean_xml))
         for _, el in it:
-            if '}' in el.tag:
-                el.tag = el.tag.split('}', 1)[1]
+            el.tag = el.tag.rpartition('}')[2]
         root = it.root
         
         # Funzione helper per estrazione testo
@@ -0,0 +1,70 @@
+import os
+import tempfile
+import unittest
+from concurrent.futures.process import BrokenProcessPool
+from unittest import mock
+
+import xml_fatture_processor as xfp
+
+FATTURA_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<p:FatturaElettronica xmlns:p="http://ivaservizi.agenziaentrate.gov.it/docs/xsd/fatture/v1.2" versione="FPR12">
+<FatturaElettronicaHeader>
+<CedentePrestatore><DatiAnagrafici><IdFiscaleIVA><IdPaese>IT</IdPaese><IdCodice>01234567891</IdCodice></IdFiscaleIVA><CodiceFiscale>RSSMRA80A01H501U</CodiceFiscale><Anagrafica><Nome>Mario</Nome><Cognome>Rossi</Cognome></Anagrafica></DatiAnagrafici></CedentePrestatore>
+<CessionarioCommittente><DatiAnagrafici><IdFiscaleIVA><IdPaese>IT</IdPaese><IdCodice>09876543210</IdCodice></IdFiscaleIVA><Anagrafica><Denominazione>Cliente SRL</Denominazione></Anagrafica></DatiAnagrafici></CessionarioCommittente>
+</FatturaElettronicaHeader>
+<FatturaElettronicaBody><DatiGenerali><DatiGeneraliDocumento><Data>2024-03-15</Data><Numero>12/A</Numero><DatiRitenuta><ImportoRitenuta>20.00</ImportoRitenuta></DatiRitenuta></DatiGeneraliDocumento></DatiGenerali></FatturaElettronicaBody>
+</p:FatturaElettronica>
+"""
+
+
+class ProcessFileTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".xml")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(FATTURA_XML)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def assert_fattura(self, fattura):
+        self.assertEqual(fattura.stato_elaborazione, "OK")
+        self.assertEqual(fattura.cedente_partita_iva, "01234567891")
+        self.assertEqual(fattura.cedente_denominazione, "Mario Rossi")
+        self.assertEqual(fattura.cessionario_partita_iva, "09876543210")
+        self.assertEqual(fattura.cessionario_denominazione, "Cliente SRL")
+        self.assertEqual(fattura.numero, "12/A")
+        self.assertEqual(fattura.importo_ritenuta, 20.0)
+        self.assertTrue(fattura.ritenuta_applicata)
+        # Stringhe semplici: nessun riferimento all'albero lxml
+        self.assertIs(type(fattura.cedente_partita_iva), str)
+        self.assertIs(type(fattura.cedente_id_fiscale), str)
+
+    @unittest.skipUnless(hasattr(xfp, "LET"), "lxml non installato")
+    def test_process_file_lxml(self):
+        self.assert_fattura(xfp.process_file(self.path, "fattura.xml"))
+
+    def test_process_file(self):
+        self.assert_fattura(xfp.process_file(self.path, "fattura.xml"))
+
+
+class ReadFattureTest(unittest.TestCase):
+    def test_broken_pool_falls_back_to_serial(self):
+        cartella = tempfile.TemporaryDirectory()
+        self.addCleanup(cartella.cleanup)
+        for i in range(xfp.PARALLEL_MIN_FILES):
+            with open(os.path.join(cartella.name, f"f{i}.xml"), "w", encoding="utf-8") as f:
+                f.write(FATTURA_XML)
+
+        pool = mock.Mock()
+        pool.map.side_effect = BrokenProcessPool("worker terminato")
+        with mock.patch.object(xfp, "MAX_WORKERS", 2), mock.patch.object(xfp, "_process_pool", pool):
+            fatture = xfp.read_fatture(cartella.name)
+            # Pool scartato: la prossima esecuzione ne crea uno nuovo
+            self.assertIsNone(xfp._process_pool)
+        pool.shutdown.assert_called_once()
+        self.assertEqual(len(fatture), xfp.PARALLEL_MIN_FILES)
+        self.assertTrue(all(fattura.stato_elaborazione == "OK" for fattura in fatture))
+
+
+if __name__ == "__main__":
+    unittest.main()
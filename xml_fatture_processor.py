@@ -1,24 +1,69 @@
 import os
+import re
 import datetime
 import sys
+import argparse
+import multiprocessing
 import subprocess
-from dataclasses import dataclass
-from typing import List, Dict, Optional, Tuple
-from xml.etree.ElementTree import parse
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from functools import lru_cache
+from operator import attrgetter
+from typing import List, Dict, Iterator, Optional, Set, Tuple
 from fpdf import FPDF, XPos, YPos
-from prettytable import PrettyTable
+
+# Parser XML: lxml (libxml2) se installato, altrimenti la libreria standard
+try:
+    from lxml import etree as LET
+    XML_PARSER = LET.XMLParser(remove_blank_text=True, collect_ids=False, resolve_entities=False)
+
+    def parse(source):
+        return LET.parse(source, parser=XML_PARSER)
+
+    def compile_text_path(path: str):
+        # XPath compilata una sola volta a livello di modulo; str semplici (non "smart string" di lxml),
+        # così sys.intern le accetta e i risultati non tengono in vita l'albero
+        xpath = LET.XPath(f"{path}/text()", smart_strings=False)
+
+        def find_text(node) -> Optional[str]:
+            result = xpath(node)
+            return result[0] if result else None
+        return find_text
+except ImportError:
+    from xml.etree.ElementTree import parse
+
+    def compile_text_path(path: str):
+        return lambda node: node.findtext(path)
+
+# Percorsi dei campi letti da process_file
+XP_CODICE_FISCALE = compile_text_path('DatiAnagrafici/CodiceFiscale')
+XP_PARTITA_IVA = compile_text_path('DatiAnagrafici/IdFiscaleIVA/IdCodice')
+XP_DATA = compile_text_path('Data')
+XP_NUMERO = compile_text_path('Numero')
+XP_IMPORTO_RITENUTA = compile_text_path('ImportoRitenuta')
 
 # Versione del software
 VERSION = "1.7.3 del 02-02-2025"
 
 pdf_file_path = "fatture.pdf"
+# Processi per la lettura parallela delle fatture (sovrascrivibile con XML_FATTURE_WORKERS)
+MAX_WORKERS = int(os.environ.get("XML_FATTURE_WORKERS", "0")) or max(1, (os.cpu_count() or 2) - 1)
+# Sotto questa soglia il costo di avvio del pool supera il guadagno
+PARALLEL_MIN_FILES = 32
+# Stato delle fatture saltate con -R perché prive di DatiRitenuta
+STATO_SENZA_RITENUTA = "SENZA RITENUTA"
+# Partita IVA: esattamente 11 cifre
+PIVA_PATTERN = re.compile(r'^[0-9]{11}$')
 # Dizionario per tradurre i mesi in italiano
 mesi_italiani = {
     1: "Gennaio", 2: "Febbraio", 3: "Marzo", 4: "Aprile", 5: "Maggio", 6: "Giugno",
     7: "Luglio", 8: "Agosto", 9: "Settembre", 10: "Ottobre", 11: "Novembre", 12: "Dicembre"
 }
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Fattura:
     cedente_id_fiscale: str
     cedente_partita_iva: str
@@ -32,23 +77,70 @@ class Fattura:
     importo_ritenuta: float
     stato_elaborazione: str
     nome_file: str
+    # Stringhe di presentazione calcolate una volta, riusate da tabella e PDF
+    data_str: str = field(init=False, repr=False)
+    ritenuta_str: str = field(init=False, repr=False)
+    importo_str: str = field(init=False, repr=False)
+    # Anno e mese letti direttamente nei cicli di aggregazione
+    year: int = field(init=False, repr=False)
+    month: int = field(init=False, repr=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, 'year', self.data.year)
+        object.__setattr__(self, 'month', self.data.month)
+        object.__setattr__(self, 'data_str', self.data.strftime('%d/%m/%Y') if self.stato_elaborazione == "OK" else "-")
+        object.__setattr__(self, 'ritenuta_str', "SI" if self.ritenuta_applicata else "NO")
+        object.__setattr__(self, 'importo_str', f"{self.importo_ritenuta:.2f}" if self.ritenuta_applicata else "-")
+
+@dataclass(slots=True)
+class SupplierBucket:
+    partita_iva: str
+    id_fiscale: str
+    by_month: Dict[Tuple[int, int], List[Fattura]] = field(default_factory=lambda: defaultdict(list))
+    totali_mese: Dict[Tuple[int, int], float] = field(default_factory=lambda: defaultdict(float))
+    totale_periodo: float = 0.0
+    clienti: Set[str] = field(default_factory=set)
 
 def truncate_string(value: str, max_length: int = 25) -> str:
     return value if len(value) <= max_length else value[:max_length] + "..."
 
-def get_denominazione_or_nome_cognome(node):
-    denominazione = node.find('Denominazione')
-    if denominazione is not None and denominazione.text:
-        return denominazione.text
-
-    nome = node.find('Nome')
-    cognome = node.find('Cognome')
-    if nome is not None and cognome is not None:
-        return f"{nome.text} {cognome.text}"
+@lru_cache(maxsize=4096)
+def truncate_cached(value: str, max_length: int = 25) -> str:
+    # Denominazioni, nomi file ed etichette si ripetono tra le righe del PDF
+    return truncate_string(value, max_length)
 
-    return "Dati anagrafici mancanti"
+def parse_iso_date(text: str) -> datetime.date:
+    # Formato fisso AAAA-MM-GG: slicing e int evitano il costo di strptime
+    if len(text) == 10 and text[4] == '-' and text[7] == '-':
+        return datetime.date(int(text[0:4]), int(text[5:7]), int(text[8:10]))
+    return datetime.datetime.strptime(text, '%Y-%m-%d').date()
 
-def process_file(file_path: str, file_name: str) -> Fattura:
+def get_denominazione_or_nome_cognome(node):
+    # findtext restituisce direttamente il testo, senza passare dall'elemento
+    denominazione = node.findtext('Denominazione')
+    if denominazione:
+        return denominazione
+
+    nome_cognome = f"{node.findtext('Nome', '')} {node.findtext('Cognome', '')}".strip()
+    return nome_cognome or "Dati anagrafici mancanti"
+
+def _fattura_non_elaborata(file_name: str, stato: str) -> Fattura:
+    return Fattura(
+        cedente_id_fiscale="",
+        cedente_partita_iva="",
+        cedente_denominazione="",
+        cessionario_id_fiscale="",
+        cessionario_partita_iva="",
+        cessionario_denominazione="",
+        data=datetime.date.today(),
+        numero="",
+        ritenuta_applicata=False,
+        importo_ritenuta=0.0,
+        stato_elaborazione=stato,
+        nome_file=file_name
+    )
+
+def process_file(file_path: str, file_name: str, ritenuta_only: bool = False) -> Fattura:
     try:
         tree = parse(file_path)
         root = tree.getroot()
@@ -60,25 +152,28 @@ def process_file(file_path: str, file_name: str) -> Fattura:
         dati_generali = body.find('DatiGenerali')
         dati_generali_documento = dati_generali.find('DatiGeneraliDocumento')
 
-        cedente_id_fiscale = cedente.find('DatiAnagrafici/CodiceFiscale')
-        cedente_id_fiscale = cedente_id_fiscale.text if cedente_id_fiscale is not None else "CF. Cedente ND"
+        ritenuta = dati_generali_documento.find('DatiRitenuta')
+        if ritenuta_only and ritenuta is None:
+            # Con -R le fatture senza ritenuta verrebbero comunque scartate: inutile estrarre il resto
+            return _fattura_non_elaborata(file_name, STATO_SENZA_RITENUTA)
+
+        cedente_id_fiscale = XP_CODICE_FISCALE(cedente) or "CF. Cedente ND"
 
-        cedente_partita_iva = cedente.find('DatiAnagrafici/IdFiscaleIVA/IdCodice')
-        cedente_partita_iva = cedente_partita_iva.text if cedente_partita_iva is not None else "PIVA Cedente ND"
-        cedente_denominazione = get_denominazione_or_nome_cognome(cedente.find('DatiAnagrafici/Anagrafica'))
+        cedente_partita_iva = XP_PARTITA_IVA(cedente)
+        # sys.intern: stesso fornitore/cliente su molte fatture condivide un'unica stringa
+        cedente_partita_iva = sys.intern(cedente_partita_iva) if cedente_partita_iva else "PIVA Cedente ND"
+        cedente_denominazione = sys.intern(get_denominazione_or_nome_cognome(cedente.find('DatiAnagrafici/Anagrafica')))
 
-        cessionario_id_fiscale = cessionario.find('DatiAnagrafici/CodiceFiscale')
-        cessionario_id_fiscale = cessionario_id_fiscale.text if cessionario_id_fiscale is not None else "NO_CF_cessionario"
+        cessionario_id_fiscale = XP_CODICE_FISCALE(cessionario) or "NO_CF_cessionario"
 
-        cessionario_partita_iva = cessionario.find('DatiAnagrafici/IdFiscaleIVA/IdCodice')
-        cessionario_partita_iva = cessionario_partita_iva.text if cessionario_partita_iva is not None else "NO_PIVA_cessionario"
-        cessionario_denominazione = get_denominazione_or_nome_cognome(cessionario.find('DatiAnagrafici/Anagrafica'))
+        cessionario_partita_iva = XP_PARTITA_IVA(cessionario)
+        cessionario_partita_iva = sys.intern(cessionario_partita_iva) if cessionario_partita_iva else "NO_PIVA_cessionario"
+        cessionario_denominazione = sys.intern(get_denominazione_or_nome_cognome(cessionario.find('DatiAnagrafici/Anagrafica')))
 
-        data = datetime.datetime.strptime(dati_generali_documento.find('Data').text, '%Y-%m-%d').date()
-        numero = dati_generali_documento.find('Numero').text
+        data = parse_iso_date(XP_DATA(dati_generali_documento))
+        numero = XP_NUMERO(dati_generali_documento) or ""
 
-        ritenuta = dati_generali_documento.find('DatiRitenuta')
-        importo_ritenuta = float(ritenuta.find('ImportoRitenuta').text) if ritenuta is not None else 0.0
+        importo_ritenuta = float(XP_IMPORTO_RITENUTA(ritenuta)) if ritenuta is not None else 0.0
         has_ritenuta = importo_ritenuta > 0
 
         return Fattura(
@@ -96,20 +191,27 @@ def process_file(file_path: str, file_name: str) -> Fattura:
             nome_file=file_name
         )
     except Exception as e:
-        return Fattura(
-            cedente_id_fiscale="",
-            cedente_partita_iva="",
-            cedente_denominazione="",
-            cessionario_id_fiscale="",
-            cessionario_partita_iva="",
-            cessionario_denominazione="",
-            data=datetime.date.today(),
-            numero="",
-            ritenuta_applicata=False,
-            importo_ritenuta=0.0,
-            stato_elaborazione=f"KO: {e}",
-            nome_file=file_name
-        )
+        return _fattura_non_elaborata(file_name, f"KO: {e}")
+
+def _decode_p7m_file(input_file_path: str, filename: str) -> str:
+    file_path_p7m = os.path.join(input_file_path, filename)
+    split_filename = os.path.splitext(filename)  # Divide il nome dal suffisso
+    file_name_decript = os.path.join(input_file_path, split_filename[0])  # Nome senza estensione .p7m
+
+    # Comando OpenSSL per decrittare e verificare il file (argv, senza shell)
+    command = ["openssl", "cms", "-decrypt", "-verify", "-inform", "DER", "-in", file_path_p7m, "-noverify", "-out", file_name_decript]
+    righe = [f"Eseguendo comando: {' '.join(command)}"]
+
+    try:
+        subprocess.run(command, check=True)
+        righe.append(f"File decrittato con successo: {file_name_decript}")
+
+        # Rimuove il file .p7m dopo la decodifica
+        os.remove(file_path_p7m)
+        righe.append(f"File .p7m eliminato: {file_path_p7m}")
+    except (subprocess.CalledProcessError, OSError) as e:
+        righe.append(f"Errore durante la decrittazione del file {filename}: {e}")
+    return "\n".join(righe)
 
 def decode_p7m_files(input_file_path: str):
     # Verifica che il percorso di input esista e sia una directory
@@ -117,83 +219,123 @@ def decode_p7m_files(input_file_path: str):
         raise FileNotFoundError(f"La cartella di input '{input_file_path}' non esiste o non è una directory.")
 
     # Verifica se la cartella contiene file
-    if not os.listdir(input_file_path):
+    filenames = os.listdir(input_file_path)
+    if not filenames:
         print("La cartella di input è vuota.")
-    else:
-        # Elabora i file .p7m nella cartella
-        for filename in os.listdir(input_file_path):
-            if filename.lower().endswith(".p7m") and "metadato" not in filename.lower():
-                file_path_p7m = os.path.join(input_file_path, filename)
-                split_filename = os.path.splitext(filename)  # Divide il nome dal suffisso
-                file_name_decript = os.path.join(input_file_path, split_filename[0])  # Nome senza estensione .p7m
-
-                # Comando OpenSSL per decrittare e verificare il file
-                command = (
-                    f"openssl cms -decrypt -verify -inform DER -in \"{file_path_p7m}\" -noverify -out \"{file_name_decript}\""
-                )
-                print(f"Eseguendo comando: {command}")
-
-                try:
-                    subprocess.run(command, shell=True, check=True)
-                    print(f"File decrittato con successo: {file_name_decript}")
-
-                    # Rimuove il file .p7m dopo la decodifica
-                    os.remove(file_path_p7m)
-                    print(f"File .p7m eliminato: {file_path_p7m}")
-                except subprocess.CalledProcessError as e:
-                    print(f"Errore durante la decrittazione del file {filename}: {e}")
-
-def read_fatture(folder_path: str) -> List[Fattura]:
-    fatture = []
-    fatture_table = PrettyTable(["#", "Nome Fattura", "Fornitore", "Cliente", "Numero", "Data", "Ritenuta", "Importo Ritenuta", "Elaborazione"])
-
-    for root, _, files in os.walk(folder_path):
-        for file_name in files:
-            if file_name.endswith(('.xml', '.p7m')) and "metadato" not in file_name.lower():
-                file_path = os.path.join(root, file_name)
-                fattura = process_file(file_path, file_name)
-                fatture.append(fattura)
-
-    for idx, fattura in enumerate(fatture, start=1):
-        fatture_table.add_row([
-            idx, fattura.nome_file, truncate_string(fattura.cedente_denominazione), truncate_string(fattura.cessionario_denominazione), fattura.numero,
-            fattura.data.strftime('%d/%m/%Y') if fattura.stato_elaborazione == "OK" else "-",
-            "SI" if fattura.ritenuta_applicata else "NO",
-            f"{fattura.importo_ritenuta:.2f}" if fattura.ritenuta_applicata else "-",
-            fattura.stato_elaborazione
-        ])
-
-    print(fatture_table)
-    return fatture
-
-def aggregate_by_supplier_and_client(fatture: List[Fattura]) -> Dict[str, Dict[Tuple[int, int], List[Fattura]]]:
+        return
+
+    # Elabora i file .p7m nella cartella: ogni openssl è un processo indipendente
+    p7m_files = [f for f in filenames if f.lower().endswith(".p7m") and "metadato" not in f.lower()]
+    if not p7m_files:
+        return
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for esito in executor.map(lambda filename: _decode_p7m_file(input_file_path, filename), p7m_files):
+            print(esito)
+
+def format_fatture_table(fatture: List[Fattura]) -> str:
+    headers = ["#", "Nome Fattura", "Fornitore", "Cliente", "Numero", "Data", "Ritenuta", "Importo Ritenuta", "Elaborazione"]
+    rows = [[
+        str(idx), fattura.nome_file, truncate_string(fattura.cedente_denominazione), truncate_string(fattura.cessionario_denominazione), fattura.numero,
+        fattura.data_str,
+        fattura.ritenuta_str,
+        fattura.importo_str,
+        fattura.stato_elaborazione
+    ] for idx, fattura in enumerate(fatture, start=1)]
+
+    # Larghezze colonne calcolate in un solo passaggio, poi un'unica stringa da stampare
+    widths = [len(header) for header in headers]
+    for row in rows:
+        widths = [max(width, len(value)) for width, value in zip(widths, row)]
+
+    separator = "+" + "+".join("-" * (width + 2) for width in widths) + "+"
+    lines = [separator, "| " + " | ".join(h.center(w) for h, w in zip(headers, widths)) + " |", separator]
+    lines.extend("| " + " | ".join(v.ljust(w) for v, w in zip(row, widths)) + " |" for row in rows)
+    lines.append(separator)
+    return "\n".join(lines)
+
+def _process_file_args(args: Tuple[str, str, bool]) -> Fattura:
+    return process_file(*args)
+
+def print_fatture_table(fatture: List[Fattura]) -> None:
+    print(format_fatture_table(fatture))
+
+def iter_fattura_files(folder_path: str) -> Iterator[Tuple[str, str]]:
+    # os.scandir riusa il tipo restituito dalla directory: niente stat aggiuntive come os.walk
+    try:
+        entries = os.scandir(folder_path)
+    except OSError:
+        # Come os.walk: le cartelle non leggibili vengono ignorate
+        return
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_fattura_files(entry.path)
+            elif entry.is_file():
+                file_name = entry.name
+                if file_name.endswith(('.xml', '.p7m')) and "metadato" not in file_name.lower():
+                    yield entry.path, file_name
+
+_process_pool: Optional[ProcessPoolExecutor] = None
+
+def get_process_pool() -> ProcessPoolExecutor:
+    """Pool di processi creato alla prima richiesta e riusato dalle esecuzioni successive di main().
+
+    Chi chiama main() più volte nello stesso processo (la GUI) paga avvio e import dei worker una volta sola.
+    I worker sono avviati con "spawn" su ogni piattaforma: la GUI crea il pool da un thread di lavoro
+    mentre gira Tk, e un fork di un processo con più thread può ereditare lock già acquisiti e bloccarsi."""
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(max_workers=MAX_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _process_pool
+
+def read_fatture(folder_path: str, ritenuta_only: bool = False) -> List[Fattura]:
+    file_args = [(file_path, file_name, ritenuta_only) for file_path, file_name in iter_fattura_files(folder_path)]
+
+    # Ogni file è indipendente: il parsing XML viene distribuito su più processi
+    if MAX_WORKERS > 1 and len(file_args) >= PARALLEL_MIN_FILES:
+        global _process_pool
+        try:
+            return list(get_process_pool().map(_process_file_args, file_args, chunksize=16))
+        except BrokenProcessPool:
+            # Un worker terminato rende inutilizzabile il pool: scartato (la prossima esecuzione ne crea uno nuovo)
+            # e questa esecuzione completata nel processo corrente
+            _process_pool.shutdown(wait=False, cancel_futures=True)
+            _process_pool = None
+            print("Pool di processi non più utilizzabile: lettura delle fatture nel processo principale")
+    return [process_file(*args) for args in file_args]
+
+def aggregate_by_supplier_and_client(fatture: List[Fattura], start_date: Optional[datetime.date] = None, end_date: Optional[datetime.date] = None) -> Dict[str, SupplierBucket]:
+    # Raggruppamento per anno/mese, totali ritenute e clienti di ogni fornitore in un unico passaggio
+    lo = start_date or datetime.date.min
+    hi = end_date or datetime.date.max
     aggregato = {}
     for fattura in fatture:
         key = fattura.cedente_denominazione
-        year_month = (fattura.data.year, fattura.data.month)
-        if key not in aggregato:
-            aggregato[key] = {}
-        if year_month not in aggregato[key]:
-            aggregato[key][year_month] = []
-        aggregato[key][year_month].append(fattura)
+        year_month = (fattura.year, fattura.month)
+        # Un solo lookup per fornitore; mesi e totali sono defaultdict, senza test di appartenenza
+        bucket = aggregato.get(key)
+        if bucket is None:
+            bucket = aggregato[key] = SupplierBucket(partita_iva=fattura.cedente_partita_iva, id_fiscale=fattura.cedente_id_fiscale)
+        bucket.by_month[year_month].append(fattura)
+        bucket.clienti.add(f"{fattura.cessionario_denominazione} (COD.FISC. {fattura.cessionario_id_fiscale} Part.IVA {fattura.cessionario_partita_iva})")
+        if fattura.ritenuta_applicata:
+            bucket.totali_mese[year_month] += fattura.importo_ritenuta
+            if lo <= fattura.data <= hi:
+                bucket.totale_periodo += fattura.importo_ritenuta
+
+    # Ordina una sola volta mesi e fatture: i chiamanti iterano già nell'ordine corretto
+    by_data = attrgetter('data')
+    for bucket in aggregato.values():
+        for fatture_gruppo in bucket.by_month.values():
+            fatture_gruppo.sort(key=by_data)
+        bucket.by_month = dict(sorted(bucket.by_month.items()))
     return aggregato
 
 def filter_fatture_by_date_and_ritenuta(fatture: List[Fattura], start_date: Optional[datetime.date], end_date: Optional[datetime.date]) -> List[Fattura]:
-    filtered_fatture = []
-    for fattura in fatture:
-        if fattura.ritenuta_applicata:
-            if start_date and end_date:
-                if start_date <= fattura.data <= end_date:
-                    filtered_fatture.append(fattura)
-            elif start_date:
-                if fattura.data >= start_date:
-                    filtered_fatture.append(fattura)
-            elif end_date:
-                if fattura.data <= end_date:
-                    filtered_fatture.append(fattura)
-            else:
-                filtered_fatture.append(fattura)
-    return filtered_fatture
+    # Estremi mancanti sostituiti da date sentinella: un solo confronto per fattura
+    lo = start_date or datetime.date.min
+    hi = end_date or datetime.date.max
+    return [f for f in fatture if f.ritenuta_applicata and lo <= f.data <= hi]
 
 def filter_fatture_by_partita_iva(fatture: List[Fattura], partita_iva: str, is_fornitore: bool) -> List[Fattura]:
     filtered_fatture = []
@@ -204,14 +346,41 @@ def filter_fatture_by_partita_iva(fatture: List[Fattura], partita_iva: str, is_f
             filtered_fatture.append(fattura)
     return filtered_fatture
 
-def export_to_pdf(fatture: List[Fattura], pdf_file_path: str, start_date: Optional[datetime.date], end_date: Optional[datetime.date], save_output: bool = False, output_text: str = ""):
+def index_fatture_by_partita_iva(fatture: List[Fattura]) -> Tuple[Dict[str, List[Fattura]], Dict[str, List[Fattura]]]:
+    # Indici P.IVA -> fatture costruiti una sola volta, per fornitore e per cliente
+    idx_fornitore = defaultdict(list)
+    idx_cliente = defaultdict(list)
+    for fattura in fatture:
+        idx_fornitore[fattura.cedente_partita_iva].append(fattura)
+        idx_cliente[fattura.cessionario_partita_iva].append(fattura)
+    return idx_fornitore, idx_cliente
+
+def render_summary(aggregato: Dict[str, SupplierBucket]) -> str:
+    righe = ["Riepilogo Totale Ritenute per Fornitore e Cliente:"]
+    for fornitore, bucket in aggregato.items():
+        righe.append(f"Fornitore: {fornitore}, Totale Ritenute per il periodo: {bucket.totale_periodo:.2f} Euro")
+        for year, month in bucket.by_month:
+            righe.append(f"  Mese: {mesi_italiani[month]} {year}, Totale Ritenute: {bucket.totali_mese[(year, month)]:.2f} Euro")
+    return "\n".join(righe) + "\n"
+
+def export_to_pdf(fatture: List[Fattura], pdf_file_path: str, start_date: Optional[datetime.date], end_date: Optional[datetime.date], save_output: bool = False, output_text: str = "", aggregato: Optional[Dict[str, SupplierBucket]] = None):
     pdf = FPDF(orientation="L", unit="mm", format="A4")
     pdf.set_auto_page_break(auto=True, margin=15)
-    pdf.set_font("Helvetica", size=10)
+
+    # Evita di reimpostare il font se è già quello corrente
+    font_corrente = None
+
+    def set_font(style: str = "", size: int = 10):
+        nonlocal font_corrente
+        if font_corrente != (style, size):
+            pdf.set_font("Helvetica", style=style, size=size)
+            font_corrente = (style, size)
+
+    set_font(size=10)
 
     # Intestazione del programma
     pdf.add_page()
-    pdf.set_font("Helvetica", style="B", size=12)
+    set_font(style="B", size=12)
     pdf.cell(0, 10, f"XML Fatture Processor {VERSION} di S.re Crapanzano - Licenza GNU-GPL - Agrigento Città della Cultura 2025", new_x=XPos.LMARGIN, new_y=YPos.NEXT, align="C")
     pdf.ln(1)
 
@@ -222,41 +391,38 @@ def export_to_pdf(fatture: List[Fattura], pdf_file_path: str, start_date: Option
         # pdf.ln(1)
 
     oggi = datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')
-    grouped_fatture = aggregate_by_supplier_and_client(fatture)
+    if aggregato is None:
+        aggregato = aggregate_by_supplier_and_client(fatture, start_date, end_date)
+    # Totale complessivo formattato una sola volta, ripetuto nel riepilogo di ogni fornitore
+    totale_periodo_tutto = format(sum(bucket.totale_periodo for bucket in aggregato.values()), '.2f')
 
     # Aggiungi il riepilogo totale delle ritenute nella prima pagina
-    pdf.set_font("Helvetica", style="B", size=12)
+    set_font(style="B", size=12)
     pdf.cell(0, 10, f"{periodo} - Riepilogo totale ritenute per Fornitore e Cliente:", new_x=XPos.LMARGIN, new_y=YPos.NEXT, align="C")
-    pdf.set_font("Helvetica", size=10)
+    set_font(size=10)
     pdf.ln(1)
 
-    for fornitore, fatture_per_mese in grouped_fatture.items():
-        totale_periodo_tutto = sum(f.importo_ritenuta for f in fatture if f.ritenuta_applicata and (not start_date or f.data >= start_date) and (not end_date or f.data <= end_date))
-        totale_periodo_fornitore = sum(f.importo_ritenuta for f in filtered_fatture if f.ritenuta_applicata and f.cedente_denominazione == fornitore and (not start_date or f.data >= start_date) and (not end_date or f.data <= end_date))
+    for fornitore, bucket in aggregato.items():
         # Imposta il font in grassetto
-        pdf.set_font("Helvetica", style="B", size=10)
-        pdf.cell(0, 10, f"Fornitore: {fornitore} (P.IVA: {fatture_per_mese[next(iter(fatture_per_mese))][0].cedente_partita_iva} - C.FISC.: {fatture_per_mese[next(iter(fatture_per_mese))][0].cedente_id_fiscale})", new_x=XPos.LMARGIN, new_y=YPos.NEXT, align="L")
-        pdf.set_font("Helvetica", size=10)
-        pdf.cell(0, 10, f"Totale Ritenute per il {periodo} Euro {totale_periodo_tutto:.2f} di cui per il fornitore Euro {totale_periodo_fornitore:.2f}", new_x=XPos.LMARGIN, new_y=YPos.NEXT, align="L")
+        set_font(style="B", size=10)
+        pdf.cell(0, 10, f"Fornitore: {fornitore} (P.IVA: {bucket.partita_iva} - C.FISC.: {bucket.id_fiscale})", new_x=XPos.LMARGIN, new_y=YPos.NEXT, align="L")
+        set_font(size=10)
+        pdf.cell(0, 10, f"Totale Ritenute per il {periodo} Euro {totale_periodo_tutto} di cui per il fornitore Euro {bucket.totale_periodo:.2f}", new_x=XPos.LMARGIN, new_y=YPos.NEXT, align="L")
         pdf.ln(1)
 
-        # Ordina le fatture per anno e mese
-        sorted_year_months = sorted(fatture_per_mese.keys())
-        for year_month in sorted_year_months:
-            fatture_gruppo = fatture_per_mese[year_month]
-            fatture_gruppo.sort(key=lambda x: x.data)
-            totale_mese = sum(f.importo_ritenuta for f in fatture_gruppo if f.ritenuta_applicata)
+        # Mesi e fatture sono già ordinati
+        for year_month in bucket.by_month:
+            totale_mese = bucket.totali_mese[year_month]
             pdf.cell(0, 10, f"  Mese: {mesi_italiani[year_month[1]]} {year_month[0]}, Totale Ritenute: {totale_mese:.2f} Euro", new_x=XPos.LMARGIN, new_y=YPos.NEXT, align="L")
 
     pdf.ln(20)
 
-    for fornitore, fatture_per_mese in grouped_fatture.items():
-        clienti = set(f"{f.cessionario_denominazione} (COD.FISC. {f.cessionario_id_fiscale} Part.IVA {f.cessionario_partita_iva})" for f in fatture if f.cedente_denominazione == fornitore)
-        clienti_str = ", ".join(clienti)
+    for fornitore, bucket in aggregato.items():
+        clienti_str = ", ".join(bucket.clienti)
         pdf.add_page()
-        pdf.set_font("Helvetica", style="B", size=10)
-        pdf.cell(0, 10, f"FORNITORE: {fornitore.upper()} (P.IVA/C.F.: {fatture_per_mese[next(iter(fatture_per_mese))][0].cedente_id_fiscale})", new_x=XPos.LMARGIN, new_y=YPos.NEXT, align="L")
-        pdf.set_font("Helvetica", size=10)
+        set_font(style="B", size=10)
+        pdf.cell(0, 10, f"FORNITORE: {fornitore.upper()} (P.IVA/C.F.: {bucket.id_fiscale})", new_x=XPos.LMARGIN, new_y=YPos.NEXT, align="L")
+        set_font(size=10)
         pdf.cell(0, 10, f"Clienti: {clienti_str}", new_x=XPos.LMARGIN, new_y=YPos.NEXT, align="L")
         pdf.cell(0, 10, f"Data e ora elaborazione: {oggi}", new_x=XPos.LMARGIN, new_y=YPos.NEXT, align="L")
         if start_date and end_date:
@@ -266,106 +432,113 @@ def export_to_pdf(fatture: List[Fattura], pdf_file_path: str, start_date: Option
         col_widths = [10, 60, 60, 30, 30, 20, 30, 40]
 
         pdf.ln()
-        for header, width in zip(headers, col_widths):
-            pdf.cell(width, 10, header, border=1, align="C")
-        pdf.ln()
-
-        idx = 1
-        # Ordina le fatture per anno e mese
-        sorted_year_months = sorted(fatture_per_mese.keys())
-        for year_month in sorted_year_months:
-            fatture_gruppo = fatture_per_mese[year_month]
-            fatture_gruppo.sort(key=lambda x: x.data)
-            for fattura in fatture_gruppo:
-                data = [
-                    idx, fattura.nome_file, truncate_string(fattura.cessionario_denominazione) + f"\n(P.IVA/C.F.: {fattura.cessionario_id_fiscale})",
-                    fattura.numero, fattura.data.strftime('%d/%m/%Y') if fattura.stato_elaborazione == "OK" else "-",
-                    "SI" if fattura.ritenuta_applicata else "NO",
-                    f"{fattura.importo_ritenuta:.2f}" if fattura.ritenuta_applicata else "-",
-                    fattura.stato_elaborazione
-                ]
-                for value, width in zip(data, col_widths):
-                    pdf.cell(width, 10, truncate_string(str(value), max_length=25), border=1, align="C")
-                pdf.ln()
-                idx += 1
+        # Tabella fpdf2 (>= 2.7): larghezze e allineamenti calcolati una volta per tabella.
+        # col_widths sono proporzioni: la tabella occupa tutta la larghezza utile (280 mm non entrano nei 277 di epw)
+        with pdf.table(width=pdf.epw, col_widths=col_widths, text_align="CENTER", align="LEFT") as table:
+            table.row(headers)
+
+            idx = 1
+            # Mesi e fatture sono già ordinati
+            for fatture_gruppo in bucket.by_month.values():
+                for fattura in fatture_gruppo:
+                    # Troncati solo i campi a lunghezza variabile; data, SI/NO e importo sono già pronti
+                    table.row([
+                        str(idx), truncate_cached(fattura.nome_file),
+                        truncate_cached(truncate_cached(fattura.cessionario_denominazione) + f"\n(P.IVA/C.F.: {fattura.cessionario_id_fiscale})"),
+                        truncate_cached(fattura.numero), fattura.data_str, fattura.ritenuta_str, fattura.importo_str,
+                        truncate_cached(fattura.stato_elaborazione)
+                    ])
+                    idx += 1
 
     if save_output:
         pdf.add_page()
-        pdf.set_font("Helvetica", size=10)
+        set_font(size=10)
         pdf.multi_cell(0, 10, output_text)
 
-    pdf.output(pdf_file_path)
+    # fpdf2 accetta un file-like: scrittura diretta su handle con buffer ampio
+    with open(pdf_file_path, 'wb', buffering=1 << 20) as pdf_file:
+        pdf.output(pdf_file)
 
 def print_syntax_error():
-    print(f"Sintassi corretta: python script.py /path/to/fatture [-R] [-M] [-FORNITORE partita_iva] [-CLIENTE partita_iva] [start_date end_date]")
+    print(f"Sintassi corretta: python script.py /path/to/fatture [-R] [-M] [-V] [-FORNITORE partita_iva] [-CLIENTE partita_iva] [start_date end_date]")
     print(f"Esempio: python script.py /path/to/fatture -R -M -FORNITORE 12345678901 01/01/2024 31/12/2024")
     print("Formato delle date: DD/MM/YYYY")
     print("Formato della partita IVA: 11 numeri")
+    print("-V (o --verbose): stampa la tabella completa delle fatture lette anche se l'output non è un terminale")
+
+class SyntaxErrorArgumentParser(argparse.ArgumentParser):
+    def error(self, message):
+        print(f"Errore: {message}")
+        print_syntax_error()
+        sys.exit(1)
+
+def partita_iva_type(value: str) -> str:
+    if not PIVA_PATTERN.match(value):
+        raise argparse.ArgumentTypeError(f"partita IVA non valida: {value}")
+    return value
+
+def date_type(value: str) -> datetime.date:
+    try:
+        # Percorso veloce per gg/mm/aaaa, strptime per le forme non zero-padded
+        if len(value) == 10 and value[2] == '/' and value[5] == '/':
+            return datetime.date(int(value[6:10]), int(value[3:5]), int(value[0:2]))
+        return datetime.datetime.strptime(value, '%d/%m/%Y').date()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"data non valida: {value}")
+
+def create_argument_parser() -> argparse.ArgumentParser:
+    parser = SyntaxErrorArgumentParser(description=f"XML Fatture Processor {VERSION}")
+    parser.add_argument('folder_path', help='Cartella contenente le fatture')
+    parser.add_argument('-R', action='store_true', help='Filtra solo le fatture con ritenuta')
+    parser.add_argument('-M', action='store_true', help='Salva il riepilogo nel PDF')
+    parser.add_argument('-V', '--verbose', action='store_true', help="Stampa la tabella delle fatture anche se l'output non è un terminale")
+    parser.add_argument('-FORNITORE', dest='fornitore', type=partita_iva_type, help='Partita IVA del fornitore')
+    parser.add_argument('-CLIENTE', dest='cliente', type=partita_iva_type, help='Partita IVA del cliente')
+    parser.add_argument('date', nargs='*', type=date_type, help='Data inizio e data fine (DD/MM/YYYY)')
+    return parser
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Esegue l'elaborazione da riga di comando; argv senza il nome dello script (default sys.argv[1:]).
+
+    Usata anche dalla GUI, che importa il modulo una volta e la chiama senza avviare un nuovo interprete."""
+    if argv is None:
+        argv = sys.argv[1:]
 
-if __name__ == "__main__":
     print(f"XML Fatture Processor {VERSION} ** Agrigento città della cultura 2025")
     print("Sviluppato da Salvatore Crapanzano")
     print("Rilasciato sotto licenza GNU-GPL")
     print()
 
-    if len(sys.argv) < 2:
+    if not argv:
         print_syntax_error()
-        sys.exit(1)
+        return 1
 
-    folder_path = sys.argv[1]
-    filter_option = '-R' in sys.argv
-    save_output_option = '-M' in sys.argv
-    fornitore_option = '-FORNITORE' in sys.argv
-    cliente_option = '-CLIENTE' in sys.argv
-    start_date_str = None
-    end_date_str = None
-    fornitore_partita_iva = None
-    cliente_partita_iva = None
-
-    # Rimuovi le opzioni -R, -M, -FORNITORE e -CLIENTE dagli argomenti
-    argv = [arg for arg in sys.argv if arg not in ['-R', '-M', '-FORNITORE', '-CLIENTE']]
-
-    if fornitore_option:
-        fornitore_index = sys.argv.index('-FORNITORE')
-        if fornitore_index + 1 < len(sys.argv):
-            fornitore_partita_iva = sys.argv[fornitore_index + 1]
-            if len(fornitore_partita_iva) != 11 or not fornitore_partita_iva.isdigit():
-                print_syntax_error()
-                sys.exit(1)
-        else:
-            print_syntax_error()
-            sys.exit(1)
-
-    if cliente_option:
-        cliente_index = sys.argv.index('-CLIENTE')
-        if cliente_index + 1 < len(sys.argv):
-            cliente_partita_iva = sys.argv[cliente_index + 1]
-            if len(cliente_partita_iva) != 11 or not cliente_partita_iva.isdigit():
-                print_syntax_error()
-                sys.exit(1)
-        else:
-            print_syntax_error()
-            sys.exit(1)
+    # La GUI passa stringhe vuote per le opzioni non selezionate: vanno scartate
+    args = create_argument_parser().parse_intermixed_args([arg for arg in argv if arg])
 
-    if filter_option:
-        if len(argv) < 4:
-            print_syntax_error()
-            sys.exit(1)
-        start_date_str = argv[2]
-        end_date_str = argv[3]
-    elif len(argv) > 2:
-        start_date_str = argv[2]
-        end_date_str = argv[3]
+    folder_path = args.folder_path
+    filter_option = args.R
+    save_output_option = args.M
+    verbose_option = args.verbose
+    fornitore_partita_iva = args.fornitore
+    cliente_partita_iva = args.cliente
 
-    try:
-        start_date = datetime.datetime.strptime(start_date_str, '%d/%m/%Y').date() if start_date_str else None
-        end_date = datetime.datetime.strptime(end_date_str, '%d/%m/%Y').date() if end_date_str else None
-    except ValueError:
+    if len(args.date) not in (0, 2) or (filter_option and not args.date):
         print_syntax_error()
-        sys.exit(1)
+        return 1
+    start_date, end_date = args.date if args.date else (None, None)
 
     decode_p7m_files(folder_path)
-    fatture = read_fatture(folder_path)
+    inizio = time.perf_counter()
+    fatture = read_fatture(folder_path, ritenuta_only=filter_option)
+
+    # La tabella serve solo a chi la legge: terminale interattivo o -V
+    if verbose_option or sys.stdout.isatty():
+        print_fatture_table(fatture)
+
+    n_ok = sum(1 for fattura in fatture if fattura.stato_elaborazione == "OK")
+    n_saltati = sum(1 for fattura in fatture if fattura.stato_elaborazione == STATO_SENZA_RITENUTA)
+    print(f"Elaborati {len(fatture)} file ({n_ok} OK, {n_saltati} senza ritenuta, {len(fatture) - n_ok - n_saltati} KO) in {time.perf_counter() - inizio:.2f}s")
 
     if not start_date or not end_date:
         # Calcola le date minime e massime delle fatture
@@ -374,20 +547,27 @@ if __name__ == "__main__":
             start_date = min(date_fatture)
             end_date = max(date_fatture)
 
+    idx_fornitore, idx_cliente = index_fatture_by_partita_iva(fatture)
+
     if fornitore_partita_iva:
-        fatture = filter_fatture_by_partita_iva(fatture, fornitore_partita_iva, is_fornitore=True)
+        fatture = idx_fornitore.get(fornitore_partita_iva, [])
 
     if cliente_partita_iva:
-        fatture = filter_fatture_by_partita_iva(fatture, cliente_partita_iva, is_fornitore=False)
+        if fornitore_partita_iva:
+            # Il sottoinsieme del fornitore è già piccolo: basta filtrarlo
+            fatture = filter_fatture_by_partita_iva(fatture, cliente_partita_iva, is_fornitore=False)
+        else:
+            fatture = idx_cliente.get(cliente_partita_iva, [])
 
     if filter_option:
         filtered_fatture = filter_fatture_by_date_and_ritenuta(fatture, start_date, end_date)
     else:
         filtered_fatture = fatture
 
-    # Ottieni i nomi del primo cliente e fornitore
-    nome_cliente = truncate_string(fatture[0].cessionario_denominazione.replace(" ", "_"), max_length=50) if fatture else "NessunCliente"
-    nome_fornitore = truncate_string(fatture[0].cedente_denominazione.replace(" ", "_"), max_length=50) if fatture else "NessunFornitore"
+    # Ottieni i nomi del primo cliente e fornitore: solo da una fattura elaborata,
+    # i segnaposto (KO o senza ritenuta con -R) hanno denominazioni vuote
+    prima_fattura = next((fattura for fattura in fatture if fattura.stato_elaborazione == "OK"), None)
+    nome_cliente = truncate_string(prima_fattura.cessionario_denominazione.replace(" ", "_"), max_length=50) if prima_fattura else "NessunCliente"
 
     # Formatta l'intervallo di date
     data_inizio = start_date.strftime('%d%m%Y') if start_date else "Inizio"
@@ -400,35 +580,33 @@ if __name__ == "__main__":
     pdf_file_path = os.path.join(folder_path, pdf_file_name)
     print(f"File PDF generato: {pdf_file_path}")
 
+    # Aggregato calcolato una volta, condiviso da riepilogo -M e PDF
+    aggregato = aggregate_by_supplier_and_client(filtered_fatture, start_date, end_date)
+
     output_text = ""
     if save_output_option:
-        output_text = "Riepilogo Totale Ritenute per Fornitore e Cliente:\n"
-        aggregato = aggregate_by_supplier_and_client(filtered_fatture)
-        for fornitore, fatture_per_mese in aggregato.items():
-            totale_periodo = sum(f.importo_ritenuta for f in filtered_fatture if f.ritenuta_applicata and f.cedente_denominazione == fornitore and (not start_date or f.data >= start_date) and (not end_date or f.data <= end_date))
-            output_text += f"Fornitore: {fornitore}, Totale Ritenute per il periodo: {totale_periodo:.2f} Euro\n"
-            sorted_year_months = sorted(fatture_per_mese.keys())
-            for year_month in sorted_year_months:
-                year, month = year_month
-                totale_mese = sum(f.importo_ritenuta for f in fatture_per_mese[year_month] if f.ritenuta_applicata)
-                output_text += f"  Mese: {mesi_italiani[month]} {year}, Totale Ritenute: {totale_mese:.2f} Euro\n"
+        output_text = render_summary(aggregato)
         print(output_text)
 
-    export_to_pdf(filtered_fatture, pdf_file_path, start_date, end_date, save_output_option, output_text)
+    export_to_pdf(filtered_fatture, pdf_file_path, start_date, end_date, save_output_option, output_text, aggregato=aggregato)
 
-# Apre automaticamente il file PDF appena generato
-if os.path.exists(pdf_file_path):
-    try:
-        if sys.platform == "win32":  # Per Windows
-            os.startfile(pdf_file_path)
-        else:
-            print("Sistema operativo non supportato per questa operazione.")
-    except Exception as e:
-        print(f"Errore durante l'apertura del file PDF: {e}. Provo con il comando 'start'...")
+    # Apre automaticamente il file PDF appena generato
+    if os.path.exists(pdf_file_path):
         try:
-            # Metodo alternativo con subprocess
-            subprocess.run(["start", "", pdf_file_path], shell=True, check=True)
-        except Exception as e2:
-            print(f"Errore con il metodo alternativo: {e2}. Controlla il visualizzatore predefinito.")
-else:
-    print(f"File PDF non trovato: {pdf_file_path}")
+            if sys.platform == "win32":  # Per Windows
+                os.startfile(pdf_file_path)
+            else:
+                print("Sistema operativo non supportato per questa operazione.")
+        except Exception as e:
+            print(f"Errore durante l'apertura del file PDF: {e}. Provo con il comando 'start'...")
+            try:
+                # Metodo alternativo con subprocess
+                subprocess.run(["start", "", pdf_file_path], shell=True, check=True)
+            except Exception as e2:
+                print(f"Errore con il metodo alternativo: {e2}. Controlla il visualizzatore predefinito.")
+    else:
+        print(f"File PDF non trovato: {pdf_file_path}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,6 +2,7 @@ import os
 import datetime
 import sys
 import subprocess
+from collections import defaultdict
 from dataclasses import dataclass
 from typing import List, Dict, Optional, Tuple
 from xml.etree.ElementTree import parse
@@ -15,7 +16,7 @@ mesi_italiani = {
     7: "Luglio", 8: "Agosto", 9: "Settembre", 10: "Ottobre", 11: "Novembre", 12: "Dicembre"
 }
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Fattura:
     cedente_id_fiscale: str
     cedente_denominazione: str
@@ -170,15 +171,9 @@ def read_fatture(folder_path: str) -> List[Fattura]:
     return fatture
 
 def aggregate_by_supplier_and_client(fatture: List[Fattura]) -> Dict[str, Dict[int, List[Fattura]]]:
-    aggregato = {}
+    aggregato = defaultdict(lambda: defaultdict(list))
     for fattura in fatture:
-        key = fattura.cedente_denominazione
-        month = fattura.data.month
-        if key not in aggregato:
-            aggregato[key] = {}
-        if month not in aggregato[key]:
-            aggregato[key][month] = []
-        aggregato[key][month].append(fattura)
+        aggregato[fattura.cedente_denominazione][fattura.data.month].append(fattura)
     return aggregato
 
 def filter_fatture_by_date_and_ritenuta(fatture: List[Fattura], start_date: Optional[datetime.date], end_date: Optional[datetime.date]) -> List[Fattura]:
@@ -256,25 +251,24 @@ def export_to_pdf(fatture: List[Fattura], pdf_file_path: str, start_date: Option
         col_widths = [10, 60, 60, 30, 30, 20, 30, 40]
 
         pdf.ln()
-        for header, width in zip(headers, col_widths):
-            pdf.cell(width, 10, header, border=1, align="C")
-        pdf.ln()
-
-        idx = 1
-        for mese, fatture_gruppo in fatture_per_mese.items():
-            fatture_gruppo.sort(key=lambda x: x.data)
-            for fattura in fatture_gruppo:
-                data = [
-                    idx, fattura.nome_file, truncate_string(fattura.cessionario_denominazione) + f"\n(P.IVA/C.F.: {fattura.cessionario_id_fiscale})",
-                    fattura.numero, fattura.data.strftime('%d/%m/%Y') if fattura.stato_elaborazione == "OK" else "-",
-                    "SI" if fattura.ritenuta_applicata else "NO",
-                    f"{fattura.importo_ritenuta:.2f}" if fattura.ritenuta_applicata else "-",
-                    fattura.stato_elaborazione
-                ]
-                for value, width in zip(data, col_widths):
-                    pdf.cell(width, 10, truncate_string(str(value), max_length=25), border=1, align="C")
-                pdf.ln()
-                idx += 1
+        # Tabella fpdf2 (>= 2.7): larghezze e allineamenti calcolati una volta per tabella.
+        # col_widths sono proporzioni: la tabella occupa tutta la larghezza utile (280 mm non entrano nei 277 di epw)
+        with pdf.table(width=pdf.epw, col_widths=col_widths, text_align="CENTER", align="LEFT") as table:
+            table.row(headers)
+
+            idx = 1
+            for mese, fatture_gruppo in fatture_per_mese.items():
+                fatture_gruppo.sort(key=lambda x: x.data)
+                for fattura in fatture_gruppo:
+                    data = [
+                        idx, fattura.nome_file, truncate_string(fattura.cessionario_denominazione) + f"\n(P.IVA/C.F.: {fattura.cessionario_id_fiscale})",
+                        fattura.numero, fattura.data.strftime('%d/%m/%Y') if fattura.stato_elaborazione == "OK" else "-",
+                        "SI" if fattura.ritenuta_applicata else "NO",
+                        f"{fattura.importo_ritenuta:.2f}" if fattura.ritenuta_applicata else "-",
+                        fattura.stato_elaborazione
+                    ]
+                    table.row([truncate_string(str(value), max_length=25) for value in data])
+                    idx += 1
 
     pdf.output(pdf_file_path)
 
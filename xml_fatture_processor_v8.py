@@ -14,7 +14,9 @@ Caratteristiche principali:
 """
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
+from requests.packages.urllib3.util.retry import Retry
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
 import json
@@ -25,19 +27,26 @@ import time
 import shutil
 import subprocess
 import hashlib
+import base64
+import sqlite3
 import xml.etree.ElementTree as ET
 import io
+import zlib
+import mmap
 import uuid
 import tempfile
 import platform
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple, Set, Any
+from typing import Dict, List, Optional, Tuple, Set, Any, BinaryIO, Iterable, Iterator
 import logging
 from dataclasses import dataclass, asdict
+from collections import Counter
 import pytz
 from tqdm import tqdm
 from urllib.parse import unquote
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import chain, islice, repeat, tee
 import argparse
 
 # Dipendenze avanzate per decodifica P7M
@@ -59,15 +68,127 @@ if platform.system() == "Windows":
 else:
     WIN32_AVAILABLE = False
 
+# Hash non crittografico per i duplicati: xxHash3 se disponibile, altrimenti SHA-256
+try:
+    import xxhash
+    XXHASH_AVAILABLE = True
+except ImportError:
+    XXHASH_AVAILABLE = False
+
+# Serializzazione JSON dei metadati: orjson se disponibile, altrimenti json della libreria standard
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+# Parser XML: lxml (libxml2) se disponibile, altrimenti ElementTree della libreria standard
+try:
+    from lxml import etree as LET
+    LXML_AVAILABLE = True
+except ImportError:
+    LXML_AVAILABLE = False
+
+if LXML_AVAILABLE:
+    # collect_ids=False: le fatture non usano xml:id, inutile indicizzarli
+    LXML_PARSER = LET.XMLParser(resolve_entities=False, no_network=True, collect_ids=False)
+    _LOWER = "translate(local-name(), 'ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')"
+
+    def _xp_anagrafica(ruolo: str, campo: str):
+        return LET.XPath(f"(//*[local-name()='{ruolo}']//*[local-name()='DatiAnagrafici']//{campo})[1]/text()")
+
+    # XPath compilate una sola volta: local-name() ignora i namespace direttamente in libxml2
+    _XP_DATA = LET.XPath("(//*[local-name()='Data'][text()])[1]/text()")
+    _XP_PIVA_CEDENTE = _xp_anagrafica('CedentePrestatore', "*[local-name()='IdFiscaleIVA']//*[local-name()='IdCodice']")
+    _XP_PIVA_CESSIONARIO = _xp_anagrafica('CessionarioCommittente', "*[local-name()='IdFiscaleIVA']//*[local-name()='IdCodice']")
+    _XP_CF_CEDENTE = _xp_anagrafica('CedentePrestatore', "*[local-name()='CodiceFiscale']")
+    _XP_CF_CESSIONARIO = _xp_anagrafica('CessionarioCommittente', "*[local-name()='CodiceFiscale']")
+    _XP_HA_RITENUTA = LET.XPath(f"boolean(//*[contains({_LOWER}, 'ritenuta')])")
+    _XP_HA_CASSA = LET.XPath(f"boolean(//*[contains({_LOWER}, 'cassa') or contains({_LOWER}, 'previdenza')])")
+    _XP_IMPORTI_RITENUTA = LET.XPath("//*[local-name()='ImportoRitenuta']/text()")
+    _XP_TIPO_RITENUTA = LET.XPath("(//*[local-name()='TipoRitenuta'][text()])[1]/text()")
+
+# Campi delle ricevute SDI: con lxml un'espressione compilata per campo, altrimenti il percorso per find()
+_CAMPI_NOTIFICA = {
+    "identificativo_sdi": "IdentificativoSdI",
+    "nome_file": "NomeFile",
+    "hash_file": "Hash",
+    "data_ora_ricezione": "DataOraRicezione",
+    "data_ora_consegna": "DataOraConsegna",
+    "riferimento_fattura": "RiferimentoFattura",
+    "posizione_nella_fattura": "PosizioneNellaFattura",
+}
+if LXML_AVAILABLE:
+    # Sui tag già privati del namespace: primo discendente in ordine di documento, come find('.//X')
+    _XP_NOTIFICA = {chiave: LET.XPath(f"(.//{tag})[1]") for chiave, tag in _CAMPI_NOTIFICA.items()}
+else:
+    _XP_NOTIFICA = {chiave: f".//{tag}" for chiave, tag in _CAMPI_NOTIFICA.items()}
+
+def _first(values: List[str]) -> Optional[str]:
+    return values[0] if values else None
+
+def _xml_body(xml_content: str, skip_declaration: bool) -> str:
+    """Testo XML dalla dichiarazione in poi (o subito dopo, se skip_declaration), con una sola copia della stringa."""
+    start = xml_content.find('<?xml')
+    if skip_declaration and start != -1:
+        end = xml_content.find('?>', start)
+        start = end + 2 if end != -1 else start + 1
+    return xml_content[start:]
+
+def parse_xml_string_stripped(xml_content: str):
+    """Parsing di una stringa XML con rimozione dei namespace dai tag."""
+    # lxml rifiuta le stringhe con dichiarazione di encoding: il testo è già decodificato
+    clean_xml = _xml_body(xml_content, LXML_AVAILABLE)
+    if LXML_AVAILABLE:
+        root = LET.fromstring(clean_xml, parser=LXML_PARSER)
+        for el in root.iter(LET.Element):
+            el.tag = LET.QName(el).localname
+        return root
+
+    it = ET.iterparse(io.StringIO(clean_xml))
+    for _, el in it:
+        # Un solo rpartition per elemento: nessun controllo preliminare né lista da split
+        el.tag = el.tag.rpartition('}')[2]
+    return it.root
+
 # --- CONFIGURAZIONE ---
 SCRIPT_VERSION = "SISTEMA_INTEGRATO_ADE_v4.0_ADVANCED_DECODER"
 CONFIG_FILE = "config_ade_system.json"
 DEFAULT_USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+DOWNLOAD_BUFFER_SIZE = 1024 * 1024
+DOWNLOAD_CONCURRENCY = 8
+PROGRESS_UPDATE_EVERY = 64
 
 # Pattern ottimizzati per riconoscimento file
 METADATA_PATTERN = r'(_MT_|[Mm][Ee][Tt][Aa][Dd][Aa][Tt][Oo])'
 NOTIFICATION_PATTERN = r'_(?:NS|RC|MC|NE|DT|AT|SE)_'
-SUPPORTED_EXTENSIONS = {'.xml', '.p7m'}
+
+# Espressioni regolari compilate una sola volta, usate per ogni file elaborato
+_RE_METADATA = re.compile(METADATA_PATTERN)
+_RE_NOTIFICATION = re.compile(NOTIFICATION_PATTERN)
+_RE_FILE_KIND = re.compile(f'(?P<meta>{METADATA_PATTERN})|(?P<notif>{NOTIFICATION_PATTERN})')
+_RE_UNSAFE = re.compile(r'[<>:"/\\|?*]')
+_RE_WS = re.compile(r'\s+')
+# Caratteri ASCII che \s riconosce nelle stringhe str (inclusi i separatori \x1c-\x1f)
+_ASCII_WHITESPACE = b' \t\n\r\x0b\x0c\x1c\x1d\x1e\x1f'
+_RE_CD_STAR = re.compile(r"filename\*\s*=\s*([^']*)'[^']*'([^;]+)", re.IGNORECASE)
+_RE_CD_QUOTED = re.compile(r'filename\s*=\s*"([^"]+)"', re.IGNORECASE)
+_RE_CD_PLAIN = re.compile(r'filename\s*=\s*([^;]+)', re.IGNORECASE)
+_RE_LIFERAY_TOKEN = re.compile(rb"Liferay\.authToken\s*=\s*'([^']+)';")
+_RE_PEM_ARMOR = re.compile(rb'-----(?:BEGIN|END)[^-]*-----')
+SUPPORTED_EXTENSIONS = frozenset(('.xml', '.p7m'))
+# Tipo dei file senza pattern di metadato o notifica nel nome, per estensione
+_SUFFIX_FILE_TYPE = dict.fromkeys(SUPPORTED_EXTENSIONS, "INVOICE")
+P7M_CACHE_FILE = Path.home() / '.xmlfatture' / 'p7m_cache.sqlite'
+MAX_P7M_NESTING = 4
+CONTENT_HASH_PARALLEL_MIN_BYTES = 1024 * 1024
+CONTENT_HASH_BLOCK_CHARS = 64 * 1024
+P7M_MMAP_THRESHOLD = 1024 * 1024
+HASH_CACHE_FILE = Path.home() / '.xmlfatture' / 'hash_cache.sqlite'
+DUPLICATE_HASH_ALGORITHM = 'xxh3_128' if XXHASH_AVAILABLE else 'sha256'
+DUPLICATE_PREFILTER_BYTES = 64 * 1024
+MANIFEST_FILE_NAME = '.dedup_manifest.json'
+METADATA_LOG_NAME = '_index.jsonl'
 
 # --- DATACLASSES POTENZIATE ---
 @dataclass
@@ -88,6 +209,7 @@ class AdvancedProcessingResult:
     decoding_attempts: List[str] = None
     original_size: int = 0
     decoded_size: int = 0
+    original_mtime_ns: int = 0
 
     def __post_init__(self):
         if self.decoding_attempts is None:
@@ -125,7 +247,7 @@ class FatturaMetadata:
         if self.tentativi_decodifica is None:
             self.tentativi_decodifica = []
         if self.timestamp_elaborazione is None:
-            self.timestamp_elaborazione = datetime.now().isoformat()
+            self.timestamp_elaborazione = now_iso()
 
 @dataclass
 class DownloadResult:
@@ -148,7 +270,7 @@ class OrganizationResult:
     decoded_files: int = 0
     errors: List[str] = None
     client_folders_created: Dict[str, List[str]] = None
-    decoding_stats: Dict[str, int] = None
+    decoding_stats: Counter = None
 
     def __post_init__(self):
         if self.errors is None:
@@ -156,175 +278,326 @@ class OrganizationResult:
         if self.client_folders_created is None:
             self.client_folders_created = {}
         if self.decoding_stats is None:
-            self.decoding_stats = {}
+            self.decoding_stats = Counter()
+
+@dataclass
+class InvoiceFields:
+    """Campi estratti da un file fattura con un solo parsing."""
+    data_emissione: Optional[str] = None
+    anno_riferimento: Optional[int] = None
+    piva_cedente: Optional[str] = None
+    piva_cessionario: Optional[str] = None
+    cf_cedente: Optional[str] = None
+    cf_cessionario: Optional[str] = None
+    ha_ritenuta: bool = False
+    ha_cassa: bool = False
+    importo_ritenuta: float = 0.0
+    tipo_ritenuta: str = "N/D"
 
 # --- UTILITY FUNCTIONS POTENZIATE ---
 def unix_timestamp():
     return str(int(datetime.now(tz=pytz.utc).timestamp() * 1000))
 
-def calculate_file_hash(file_path: Path, algorithm: str = 'sha256') -> str:
+# utc -> (istante monotono del calcolo, timestamp ISO)
+_NOW_ISO_CACHE: Dict[bool, Tuple[float, str]] = {}
+
+def now_iso(utc: bool = False) -> str:
+    """Data e ora correnti in formato ISO, ricalcolate al più una volta al secondo (timestamp per-file nei lotti)."""
+    now = time.monotonic()
+    cached = _NOW_ISO_CACHE.get(utc)
+    if cached is None or now - cached[0] >= 1.0:
+        cached = (now, (datetime.now(timezone.utc) if utc else datetime.now()).isoformat())
+        _NOW_ISO_CACHE[utc] = cached
+    return cached[1]
+
+def fast_file_fingerprint(file_path: Path, st: Optional[os.stat_result] = None) -> str:
+    """Impronta economica del file (dimensione e mtime in ns), senza leggerne il contenuto."""
+    if st is None:
+        st = os.stat(file_path)
+    return f"{st.st_size}:{st.st_mtime_ns}"
+
+_hash_cache: Optional[sqlite3.Connection] = None
+_hash_cache_pid: Optional[int] = None
+
+def _get_hash_cache() -> Optional[sqlite3.Connection]:
+    """Connessione alla cache degli hash, aperta una volta per processo (mai ereditata da un fork)."""
+    global _hash_cache, _hash_cache_pid
+    if _hash_cache_pid != os.getpid():
+        _hash_cache_pid = os.getpid()
+        try:
+            HASH_CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+            _hash_cache = sqlite3.connect(str(HASH_CACHE_FILE), timeout=30)
+            _hash_cache.execute("PRAGMA journal_mode=WAL")
+            _hash_cache.execute("PRAGMA synchronous=NORMAL")
+            _hash_cache.execute("CREATE TABLE IF NOT EXISTS file_hashes "
+                                "(path TEXT NOT NULL, algorithm TEXT NOT NULL, fingerprint TEXT NOT NULL, "
+                                "digest TEXT NOT NULL, PRIMARY KEY (path, algorithm))")
+            _hash_cache.commit()
+        except Exception:
+            _hash_cache = None
+    return _hash_cache
+
+def calculate_file_hash(file_path: Path, algorithm: str = 'sha256', use_cache: bool = True) -> str:
     """Calcola hash del file con algoritmo specificato."""
-    if algorithm == 'md5':
-        hash_algo = hashlib.md5()
-    elif algorithm == 'sha256':
-        hash_algo = hashlib.sha256()
-    else:
-        raise ValueError(f"Algoritmo hash non supportato: {algorithm}")
+    return multi_hash(file_path, (algorithm,), use_cache)[algorithm]
+
+def multi_hash(file_path: Path, algorithms: Tuple[str, ...] = (DUPLICATE_HASH_ALGORITHM,),
+               use_cache: bool = True, st: Optional[os.stat_result] = None) -> Dict[str, str]:
+    """Calcola più hash del file con una sola lettura; restituisce un dizionario algoritmo -> digest.
+    
+    st, se il chiamante ha già fatto stat() del file, evita una seconda chiamata per l'impronta di cache."""
+    for algorithm in algorithms:
+        if algorithm not in ('md5', 'sha256') and not (algorithm == 'xxh3_128' and XXHASH_AVAILABLE):
+            raise ValueError(f"Algoritmo hash non supportato: {algorithm}")
+    
+    cache = _get_hash_cache() if use_cache else None
+    if cache is None:
+        return _compute_file_hashes(file_path, algorithms)
+    
+    # File invariato dall'ultima esecuzione (stessa dimensione e mtime): gli hash salvati sono ancora validi
+    try:
+        path_key = str(Path(file_path).resolve())
+        fingerprint = fast_file_fingerprint(file_path, st)
+        digests = dict(cache.execute(
+            f"SELECT algorithm, digest FROM file_hashes WHERE path = ? AND fingerprint = ? "
+            f"AND algorithm IN ({','.join('?' * len(algorithms))})",
+            (path_key, fingerprint, *algorithms)).fetchall())
+    except (OSError, sqlite3.Error):
+        return _compute_file_hashes(file_path, algorithms)
     
+    missing = tuple(algorithm for algorithm in algorithms if algorithm not in digests)
+    if missing:
+        computed = _compute_file_hashes(file_path, missing)
+        digests.update(computed)
+        rows = [(path_key, algorithm, fingerprint, digest) for algorithm, digest in computed.items() if digest]
+        if rows:
+            try:
+                cache.executemany("INSERT OR REPLACE INTO file_hashes (path, algorithm, fingerprint, digest) VALUES (?, ?, ?, ?)",
+                                  rows)
+                cache.commit()
+            except sqlite3.Error:
+                pass
+    return digests
+
+def _new_hasher(algorithm: str):
+    # Hash usati solo per riconoscere duplicati: nessun controllo FIPS, implementazione OpenSSL diretta
+    if algorithm == 'xxh3_128':
+        return xxhash.xxh3_128()
+    return hashlib.new(algorithm, usedforsecurity=False)
+
+def _compute_file_hashes(file_path: Path, algorithms: Tuple[str, ...]) -> Dict[str, str]:
+    hashers = {algorithm: _new_hasher(algorithm) for algorithm in algorithms}
     try:
-        with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_algo.update(chunk)
-        return hash_algo.hexdigest()
+        with open(file_path, "rb", buffering=0) as f:
+            # Python 3.11+: con un solo algoritmo lettura e aggiornamento dell'hash avvengono interamente in C
+            if len(hashers) == 1 and hasattr(hashlib, 'file_digest'):
+                (algorithm, hasher), = hashers.items()
+                return {algorithm: hashlib.file_digest(f, lambda: hasher).hexdigest()}
+            
+            # Più algoritmi: ogni blocco letto aggiorna tutti gli hash, il file passa dalla cache del SO una volta
+            buffer = memoryview(bytearray(1 << 20))
+            while True:
+                n = f.readinto(buffer)
+                if not n:
+                    break
+                chunk = buffer[:n]
+                for hasher in hashers.values():
+                    hasher.update(chunk)
+        return {algorithm: hasher.hexdigest() for algorithm, hasher in hashers.items()}
     except Exception:
-        return ""
+        return {algorithm: "" for algorithm in algorithms}
+
+def _normalized_content_digest(data: bytes) -> str:
+    hash_obj = _new_hasher(DUPLICATE_HASH_ALGORITHM)
+    hash_obj.update(data)
+    return hash_obj.hexdigest()[:16]
 
 def calculate_content_hash(content: str) -> str:
     """Calcola hash del contenuto normalizzato."""
-    normalized = re.sub(r'\s+', '', content)
-    return hashlib.sha256(normalized.encode()).hexdigest()[:16]
+    # Serve solo al confronto tra duplicati della stessa esecuzione: stesso hash veloce usato per i file
+    hash_obj = _new_hasher(DUPLICATE_HASH_ALGORITHM)
+    # Normalizzazione a blocchi: niente copie complete del contenuto in memoria
+    for start in range(0, len(content), CONTENT_HASH_BLOCK_CHARS):
+        block = content[start:start + CONTENT_HASH_BLOCK_CHARS]
+        if block.isascii():
+            hash_obj.update(block.encode('ascii').translate(None, _ASCII_WHITESPACE))
+        else:
+            # Spazi Unicode (es. NBSP) coperti da \s: stesso digest della versione con regex
+            hash_obj.update(_RE_WS.sub('', block).encode())
+    return hash_obj.hexdigest()[:16]
+
+def calculate_content_hashes_batch(contents: List[str], max_workers: Optional[int] = None) -> List[str]:
+    """Calcola in blocco gli hash del contenuto normalizzato (stesso risultato di calculate_content_hash)."""
+    payloads = [_RE_WS.sub('', content).encode() for content in contents]
+    # hashlib e xxhash rilasciano il GIL sui buffer grandi: con più payload i digest procedono in parallelo sui core
+    if len(payloads) < 2 or sum(map(len, payloads)) < CONTENT_HASH_PARALLEL_MIN_BYTES:
+        return [_normalized_content_digest(data) for data in payloads]
+    with ThreadPoolExecutor(max_workers=max_workers or min(len(payloads), os.cpu_count() or 1)) as executor:
+        return list(executor.map(_normalized_content_digest, payloads))
 
 def is_metadata(file_path: Path) -> bool:
     """Verifica se il file è un metadato."""
-    return bool(re.search(METADATA_PATTERN, file_path.name))
+    return _RE_METADATA.search(file_path.name) is not None
 
 def is_notification(file_path: Path) -> bool:
     """Verifica se il file è una ricevuta/notifica."""
-    return bool(re.search(NOTIFICATION_PATTERN, file_path.name))
+    return _RE_NOTIFICATION.search(file_path.name) is not None
 
 def is_supported_file(file_path: Path) -> bool:
     """Verifica se il file è supportato."""
     return file_path.suffix.lower() in SUPPORTED_EXTENSIONS
 
-def determine_file_type(file_path: Path) -> str:
-    """Determina il tipo di file."""
-    if is_metadata(file_path):
-        return "METADATA"
-    elif is_notification(file_path):
+def find_supported_files(source_dir: Path) -> List[Path]:
+    """File supportati sotto source_dir con una sola visita dell'albero, raggruppati per estensione."""
+    by_ext = {ext: [] for ext in SUPPORTED_EXTENSIONS}
+    for dirpath, _, filenames in os.walk(source_dir):
+        for name in filenames:
+            found = by_ext.get(os.path.splitext(name)[1].lower())
+            if found is not None:
+                found.append(Path(dirpath, name))
+    return [file_path for found in by_ext.values() for file_path in found]
+
+def determine_file_type(file_path: Path, ext: Optional[str] = None) -> str:
+    """Determina il tipo di file; ext è l'estensione minuscola, se già calcolata dal chiamante."""
+    # Una sola ricerca per metadati e notifiche; il gruppo trovato decide il tipo
+    name = file_path.name
+    match = _RE_FILE_KIND.search(name)
+    if match is not None:
+        # Se il nome contiene anche un pattern metadato dopo la notifica, prevale il metadato
+        if match.lastgroup == 'meta' or _RE_METADATA.search(name, match.end() - 1):
+            return "METADATA"
         return "NOTIFICATION"
-    elif is_supported_file(file_path):
-        return "INVOICE"
-    else:
-        return "UNSUPPORTED"
+    if ext is None:
+        ext = file_path.suffix.lower()
+    return _SUFFIX_FILE_TYPE.get(ext, "UNSUPPORTED")
 
 def safe_filename(name: str) -> str:
     """Crea nome file sicuro."""
-    return re.sub(r'[<>:"/\\|?*]', '_', name)[:200]
-
-def extract_date_from_xml(xml_file_path: Path, file_type: str) -> Tuple[Optional[str], Optional[int]]:
-    try:
-        tree = ET.parse(xml_file_path)
-        root = tree.getroot()
-        
-        for elem in root.iter():
-            if '}' in elem.tag:
-                elem.tag = elem.tag.split('}')[1]
-        
-        data_emissione = None
-        anno_riferimento = None
-        
-        for data_elem in root.iter('Data'):
-            if data_elem.text:
-                data_emissione = data_elem.text
+    return _RE_UNSAFE.sub('_', name)[:200]
+
+# Tag completo -> (nome locale, contiene 'ritenuta', contiene 'cassa'/'previdenza'): i nomi si ripetono in ogni fattura
+_TAG_INFO: Dict[str, Tuple[str, bool, bool]] = {}
+
+def _tag_info(raw_tag: str) -> Tuple[str, bool, bool]:
+    info = _TAG_INFO.get(raw_tag)
+    if info is None:
+        tag = raw_tag.rpartition('}')[2]
+        tag_lower = tag.lower()
+        info = _TAG_INFO[raw_tag] = (tag, 'ritenuta' in tag_lower, 'cassa' in tag_lower or 'previdenza' in tag_lower)
+    return info
+
+def _extract_fields_streaming(xml_file_path: Path, campi: InvoiceFields, solo_ritenuta_cassa: bool = False):
+    """Estrazione in un unico iterparse ElementTree, con memoria limitata alla profondità corrente."""
+    percorso = []
+    importo_trovato = False
+    for event, elem in ET.iterparse(xml_file_path, events=('start', 'end')):
+        tag, is_ritenuta, is_cassa = _tag_info(elem.tag)
+        if event == 'start':
+            percorso.append(tag)
+            continue
+        percorso.pop()
+        text = elem.text
+        
+        if is_ritenuta:
+            campi.ha_ritenuta = True
+        if is_cassa:
+            campi.ha_cassa = True
+        
+        if solo_ritenuta_cassa:
+            if tag == 'ImportoRitenuta' and text and not importo_trovato:
                 try:
-                    anno_riferimento = int(data_emissione[:4])
+                    campi.importo_ritenuta = float(text.replace(',', '.'))
+                    importo_trovato = True
                 except:
                     pass
-                break
-        
-        if not anno_riferimento:
-            anno_riferimento = datetime.now().year
-        
-        return data_emissione, anno_riferimento
+            elif tag == 'TipoRitenuta' and text and campi.tipo_ritenuta == "N/D":
+                campi.tipo_ritenuta = text
+            # Tutto ciò che serve è già noto: il resto del file non viene letto
+            if campi.ha_cassa and importo_trovato and campi.tipo_ritenuta != "N/D":
+                return
+            elem.clear()
+            continue
+        
+        if tag == 'Data':
+            if text and campi.data_emissione is None:
+                campi.data_emissione = text
+        elif tag == 'IdCodice' or tag == 'CodiceFiscale':
+            if 'DatiAnagrafici' in percorso:
+                if tag == 'IdCodice' and 'IdFiscaleIVA' in percorso:
+                    if 'CedentePrestatore' in percorso and campi.piva_cedente is None:
+                        campi.piva_cedente = text
+                    elif 'CessionarioCommittente' in percorso and campi.piva_cessionario is None:
+                        campi.piva_cessionario = text
+                elif tag == 'CodiceFiscale':
+                    if 'CedentePrestatore' in percorso and campi.cf_cedente is None:
+                        campi.cf_cedente = text
+                    elif 'CessionarioCommittente' in percorso and campi.cf_cessionario is None:
+                        campi.cf_cessionario = text
+        elif tag == 'ImportoRitenuta':
+            if text and not importo_trovato:
+                try:
+                    campi.importo_ritenuta = float(text.replace(',', '.'))
+                    importo_trovato = True
+                except:
+                    pass
+        elif tag == 'TipoRitenuta':
+            if text and campi.tipo_ritenuta == "N/D":
+                campi.tipo_ritenuta = text
         
-    except Exception:
-        return None, datetime.now().year
+        elem.clear()
 
-def extract_partita_iva_from_xml(xml_file_path: Path) -> Tuple[Optional[str], Optional[str], Optional[str], Optional[str]]:
+def extract_all_xml_fields(xml_file_path: Path) -> InvoiceFields:
+    """Estrae data, identificativi fiscali, ritenuta e cassa con un solo parsing del file."""
+    campi = InvoiceFields()
     try:
-        tree = ET.parse(xml_file_path)
-        root = tree.getroot()
-        
-        for elem in root.iter():
-            if '}' in elem.tag:
-                elem.tag = elem.tag.split('}')[1]
-        
-        piva_cedente = None
-        piva_cessionario = None
-        cf_cedente = None
-        cf_cessionario = None
-        
-        for cedente in root.iter('CedentePrestatore'):
-            for dati in cedente.iter('DatiAnagrafici'):
-                for piva in dati.iter('IdFiscaleIVA'):
-                    for codice in piva.iter('IdCodice'):
-                        piva_cedente = codice.text
-                        break
-                for cf in dati.iter('CodiceFiscale'):
-                    cf_cedente = cf.text
-                    break
-        
-        for cessionario in root.iter('CessionarioCommittente'):
-            for dati in cessionario.iter('DatiAnagrafici'):
-                for piva in dati.iter('IdFiscaleIVA'):
-                    for codice in piva.iter('IdCodice'):
-                        piva_cessionario = codice.text
+        if LXML_AVAILABLE:
+            tree = LET.parse(str(xml_file_path), LXML_PARSER)
+            campi.data_emissione = _first(_XP_DATA(tree))
+            campi.piva_cedente = _first(_XP_PIVA_CEDENTE(tree))
+            campi.piva_cessionario = _first(_XP_PIVA_CESSIONARIO(tree))
+            campi.cf_cedente = _first(_XP_CF_CEDENTE(tree))
+            campi.cf_cessionario = _first(_XP_CF_CESSIONARIO(tree))
+            campi.ha_ritenuta = _XP_HA_RITENUTA(tree)
+            campi.ha_cassa = _XP_HA_CASSA(tree)
+            if campi.ha_ritenuta:
+                for text in _XP_IMPORTI_RITENUTA(tree):
+                    try:
+                        campi.importo_ritenuta = float(text.replace(',', '.'))
                         break
-                for cf in dati.iter('CodiceFiscale'):
-                    cf_cessionario = cf.text
-                    break
-        
-        return piva_cedente, piva_cessionario, cf_cedente, cf_cessionario
-        
+                    except:
+                        pass
+                campi.tipo_ritenuta = _first(_XP_TIPO_RITENUTA(tree)) or "N/D"
+        else:
+            _extract_fields_streaming(xml_file_path, campi)
     except Exception:
-        return None, None, None, None
+        campi = InvoiceFields()
+    
+    if campi.data_emissione:
+        try:
+            campi.anno_riferimento = int(campi.data_emissione[:4])
+        except:
+            pass
+    if not campi.anno_riferimento:
+        campi.anno_riferimento = datetime.now().year
+    return campi
+
+def extract_date_from_xml(xml_file_path: Path, file_type: str) -> Tuple[Optional[str], Optional[int]]:
+    campi = extract_all_xml_fields(xml_file_path)
+    return campi.data_emissione, campi.anno_riferimento
+
+def extract_partita_iva_from_xml(xml_file_path: Path) -> Tuple[Optional[str], Optional[str], Optional[str], Optional[str]]:
+    campi = extract_all_xml_fields(xml_file_path)
+    return campi.piva_cedente, campi.piva_cessionario, campi.cf_cedente, campi.cf_cessionario
 
 def check_ritenuta_cassa_from_xml(xml_file_path: Path) -> Tuple[bool, bool, float, str]:
     """Verifica presenza ritenute e cassa previdenziale con importi."""
+    # Passata dedicata che si ferma appena ritenuta (importo e tipo) e cassa sono stati trovati
+    campi = InvoiceFields()
     try:
-        tree = ET.parse(xml_file_path)
-        root = tree.getroot()
-        
-        for elem in root.iter():
-            if '}' in elem.tag:
-                elem.tag = elem.tag.split('}')[1]
-        
-        ha_ritenuta = False
-        ha_cassa = False
-        importo_ritenuta = 0.0
-        tipo_ritenuta = "N/D"
-        
-        # Cerca ritenute
-        for elem in root.iter():
-            if 'ritenuta' in elem.tag.lower() or 'Ritenuta' in elem.tag:
-                ha_ritenuta = True
-                break
-        
-        # Cerca cassa previdenziale
-        for elem in root.iter():
-            if 'cassa' in elem.tag.lower() or 'Cassa' in elem.tag or 'previdenza' in elem.tag.lower():
-                ha_cassa = True
-                break
-        
-        # Estrae importo ritenuta
-        if ha_ritenuta:
-            for elem in root.iter('ImportoRitenuta'):
-                if elem.text:
-                    try:
-                        importo_ritenuta = float(elem.text.replace(',', '.'))
-                        break
-                    except:
-                        pass
-            
-            for elem in root.iter('TipoRitenuta'):
-                if elem.text:
-                    tipo_ritenuta = elem.text
-                    break
-        
-        return ha_ritenuta, ha_cassa, importo_ritenuta, tipo_ritenuta
-        
+        _extract_fields_streaming(xml_file_path, campi, solo_ritenuta_cassa=True)
     except Exception:
-        return False, False, 0.0, "N/D"
+        campi = InvoiceFields()
+    return campi.ha_ritenuta, campi.ha_cassa, campi.importo_ritenuta, campi.tipo_ritenuta
 
 def divide_in_trimestri(data_iniziale: str, data_finale: str) -> List[Tuple[str, str]]:
     def aggiusta_fine_trimestre(d: datetime) -> datetime:
@@ -356,7 +629,7 @@ def _parse_filename_from_content_disposition(header_val: str) -> Optional[str]:
     if not header_val:
         return None
     
-    m_star = re.search(r"filename\*\s*=\s*([^']*)'[^']*'([^;]+)", header_val, flags=re.IGNORECASE)
+    m_star = _RE_CD_STAR.search(header_val)
     if m_star:
         try:
             raw = m_star.group(2)
@@ -365,11 +638,11 @@ def _parse_filename_from_content_disposition(header_val: str) -> Optional[str]:
         except Exception:
             pass
     
-    m = re.search(r'filename\s*=\s*"([^"]+)"', header_val, flags=re.IGNORECASE)
+    m = _RE_CD_QUOTED.search(header_val)
     if m:
         return m.group(1)
     
-    m2 = re.search(r'filename\s*=\s*([^;]+)', header_val, flags=re.IGNORECASE)
+    m2 = _RE_CD_PLAIN.search(header_val)
     if m2:
         return m2.group(1).strip().strip('"')
     
@@ -378,35 +651,94 @@ def _parse_filename_from_content_disposition(header_val: str) -> Optional[str]:
 def determine_file_type_from_path(file_path: Path) -> str:
     path_str = str(file_path).lower()
     
+    # Il test su 'transfrontalier' si fa una volta sola e solo dove cambia il risultato
     if 'emesse' in path_str:
-        if 'transfrontalier' in path_str:
-            return 'transfrontaliere_emesse'
-        return 'emesse'
-    elif 'ricevute' in path_str:
-        if 'transfrontalier' in path_str:
-            return 'transfrontaliere_ricevute'
-        return 'ricevute'
-    elif 'passive' in path_str:
-        return 'ricevute'
-    elif 'transfrontalier' in path_str:
-        return 'transfrontaliere_ricevute'
-    else:
+        return 'transfrontaliere_emesse' if 'transfrontalier' in path_str else 'emesse'
+    if 'ricevute' not in path_str and 'passive' in path_str:
         return 'ricevute'
+    return 'transfrontaliere_ricevute' if 'transfrontalier' in path_str else 'ricevute'
 
 # --- SISTEMA DECODIFICA P7M AVANZATO ---
 class AdvancedP7MDecoder:
     """Decodificatore P7M multi-strategia con supporto ASN1, Windows API e OpenSSL."""
     
-    def __init__(self, logger: logging.Logger):
+    def __init__(self, logger: logging.Logger, cache_file: Optional[Path] = P7M_CACHE_FILE):
         self.logger = logger
-        self.stats = {
+        self.stats = Counter({
             'ASN1_SUCCESS': 0,
             'WINDOWS_API_SUCCESS': 0,
             'OPENSSL_SUCCESS': 0,
+            'CACHE_HIT': 0,
             'FAILED': 0
-        }
+        })
+        self.cache = self._open_cache(cache_file) if cache_file else None
+    
+    def _open_cache(self, cache_file: Path) -> Optional[sqlite3.Connection]:
+        """Apre la cache SQLite dei P7M già decodificati, indicizzata per SHA-256 del file."""
+        try:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(cache_file), timeout=30)
+            # WAL: più processi del pool possono leggere e scrivere insieme
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS p7m_cache "
+                         "(sha256 TEXT PRIMARY KEY, xml_content TEXT NOT NULL, method TEXT NOT NULL)")
+            conn.commit()
+            return conn
+        except Exception as e:
+            self.logger.warning(f"Cache P7M non disponibile: {e}")
+            return None
+    
+    def _cache_lookup(self, digest: Optional[str]) -> Optional[Tuple[Any, str]]:
+        if self.cache is None or digest is None:
+            return None
+        try:
+            return self.cache.execute("SELECT xml_content, method FROM p7m_cache WHERE sha256 = ?", (digest,)).fetchone()
+        except sqlite3.Error as e:
+            self.logger.debug(f"Lettura cache P7M fallita: {e}")
+            return None
+    
+    @staticmethod
+    def _write_xml(output_file: Path, xml_content):
+        # Il contenuto decodificato resta in bytes: una sola scrittura, senza codec né buffer di testo
+        if isinstance(xml_content, str):
+            xml_content = xml_content.encode('utf-8')
+        output_file.write_bytes(xml_content)
+    
+    def _save_decoded(self, output_file: Optional[Path], xml_content, digest: Optional[str], method: str):
+        """Scrive l'XML decodificato (se output_file non è None) e lo registra nella cache."""
+        if output_file is not None:
+            self._write_xml(output_file, xml_content)
+        if self.cache is None or digest is None:
+            return
+        try:
+            self.cache.execute("INSERT OR IGNORE INTO p7m_cache (sha256, xml_content, method) VALUES (?, ?, ?)",
+                               (digest, xml_content, method))
+            self.cache.commit()
+        except sqlite3.Error as e:
+            self.logger.debug(f"Scrittura cache P7M fallita: {e}")
+    
+    @staticmethod
+    def _map_p7m(input_file: Path):
+        """Legge il P7M; oltre P7M_MMAP_THRESHOLD restituisce una mappa in sola lettura senza copiarlo."""
+        with open(input_file, 'rb') as f:
+            if os.fstat(f.fileno()).st_size >= P7M_MMAP_THRESHOLD:
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return f.read()
+    
+    @staticmethod
+    def _classify_p7m(p7m_content: bytes) -> str:
+        """Riconosce il formato del P7M dai primi byte: DER, PEM (anche Base64 nudo), SMIME o UNKNOWN."""
+        # SEQUENCE con lunghezza indefinita (0x80) o in forma lunga (0x81-0x84)
+        if p7m_content[:1] == b'\x30' and b'\x80' <= p7m_content[1:2] <= b'\x84':
+            return 'DER'
+        head = p7m_content[:64].lstrip()
+        if head.startswith((b'-----BEGIN', b'MII', b'MIA')):
+            return 'PEM'
+        if head[:13].lower() == b'mime-version:':
+            return 'SMIME'
+        return 'UNKNOWN'
     
-    def extract_xml_from_p7m_asn1(self, p7m_content: bytes) -> Tuple[Optional[str], List[str]]:
+    def extract_xml_from_p7m_asn1(self, p7m_content: bytes) -> Tuple[Optional[bytes], List[str]]:
         """Decodifica P7M usando ASN1Crypto."""
         errors = []
         
@@ -420,58 +752,24 @@ class AdvancedP7MDecoder:
             # Metodo 1: estrazione diretta contenuto
             try:
                 content = content_info['content']['encap_content_info']['content'].native
-                if isinstance(content, bytes):
-                    xml_content = content.decode('utf-8', errors='ignore')
-                else:
-                    xml_content = str(content)
-                
-                if xml_content and '<?xml' in xml_content:
+                # Un contenuto che inizia con SEQUENCE (0x30) è un CMS annidato, non XML
+                if isinstance(content, bytes) and content[:1] != b'\x30' and b'<?xml' in content:
                     self.stats['ASN1_SUCCESS'] += 1
-                    return xml_content, errors
+                    return content, errors
             except Exception as e:
                 errors.append(f"ASN1 metodo 1: {str(e)}")
             
-            # Metodo 2: estrazione ricorsiva
+            # Metodo 2: P7M firmati più volte, il contenuto è a sua volta un CMS SignedData
             try:
-                def extract_content_recursive(obj):
-                    if hasattr(obj, 'native') and obj.native:
-                        content = obj.native
-                        if isinstance(content, bytes):
-                            try:
-                                decoded = content.decode('utf-8', errors='ignore')
-                                if '<?xml' in decoded:
-                                    return decoded
-                            except:
-                                pass
-                        elif isinstance(content, str) and '<?xml' in content:
-                            return content
-                    
-                    if hasattr(obj, '__iter__') and not isinstance(obj, (str, bytes)):
-                        try:
-                            for item in obj:
-                                result = extract_content_recursive(item)
-                                if result:
-                                    return result
-                        except:
-                            pass
-                    
-                    if hasattr(obj, '__dict__'):
-                        for attr_name in dir(obj):
-                            if not attr_name.startswith('_'):
-                                try:
-                                    attr_value = getattr(obj, attr_name)
-                                    result = extract_content_recursive(attr_value)
-                                    if result:
-                                        return result
-                                except:
-                                    pass
-                    
-                    return None
-                
-                xml_content = extract_content_recursive(content_info)
-                if xml_content:
-                    self.stats['ASN1_SUCCESS'] += 1
-                    return xml_content, errors
+                payload = content_info['content']['encap_content_info']['content'].native
+                for _ in range(MAX_P7M_NESTING):
+                    if not isinstance(payload, bytes):
+                        break
+                    if payload[:1] != b'\x30' and b'<?xml' in payload:
+                        self.stats['ASN1_SUCCESS'] += 1
+                        return payload, errors
+                    # Percorso CMS esplicito: i frammenti di un OCTET STRING costruito vengono uniti da .native
+                    payload = cms.ContentInfo.load(payload)['content']['encap_content_info']['content'].native
                 
             except Exception as e:
                 errors.append(f"ASN1 metodo 2: {str(e)}")
@@ -531,12 +829,28 @@ class AdvancedP7MDecoder:
         
         return None, errors
     
-    def extract_xml_from_p7m_openssl(self, p7m_path: Path) -> Tuple[Optional[str], List[str]]:
+    def extract_xml_from_p7m_pem(self, p7m_content: bytes) -> Tuple[Optional[bytes], List[str]]:
+        """Decodifica P7M in formato PEM/Base64 in-process, senza avviare OpenSSL."""
+        errors = []
+        
+        try:
+            # Rimuove intestazioni PEM e a capo: resta il DER codificato in Base64
+            der_content = base64.b64decode(_RE_PEM_ARMOR.sub(b'', p7m_content))
+        except Exception as e:
+            errors.append(f"PEM/Base64: {str(e)}")
+            return None, errors
+        
+        xml_content, asn1_errors = self.extract_xml_from_p7m_asn1(der_content)
+        errors.extend(asn1_errors)
+        return xml_content, errors
+    
+    def extract_xml_from_p7m_openssl(self, p7m_path: Path, smime: bool = False) -> Tuple[Optional[bytes], List[str]]:
         """Decodifica P7M usando OpenSSL."""
         errors = []
         
-        # Lista di comandi OpenSSL da provare
-        commands = [
+        # Lista di comandi OpenSSL da provare (le buste S/MIME usano il formato di input predefinito)
+        commands = [['openssl', 'smime', '-verify', '-noverify', '-in', str(p7m_path)]] if smime else []
+        commands += [
             ['openssl', 'cms', '-verify', '-noverify', '-inform', 'DER', '-in', str(p7m_path)],
             ['openssl', 'cms', '-decrypt', '-verify', '-inform', 'DER', '-in', str(p7m_path), '-noverify'],
             ['openssl', 'smime', '-verify', '-noverify', '-inform', 'DER', '-in', str(p7m_path)],
@@ -550,13 +864,13 @@ class AdvancedP7MDecoder:
                 result = subprocess.run(
                     command, 
                     capture_output=True, 
-                    text=True, 
+                    text=False, 
                     timeout=60,
                     check=False
                 )
                 
                 if result.returncode == 0 and result.stdout:
-                    xml_start = result.stdout.find('<?xml')
+                    xml_start = result.stdout.find(b'<?xml')
                     if xml_start != -1:
                         xml_content = result.stdout[xml_start:]
                         if xml_content:
@@ -565,7 +879,7 @@ class AdvancedP7MDecoder:
                 
                 # Prova anche stderr in caso di output misto
                 if result.stderr:
-                    xml_start = result.stderr.find('<?xml')
+                    xml_start = result.stderr.find(b'<?xml')
                     if xml_start != -1:
                         xml_content = result.stderr[xml_start:]
                         if xml_content:
@@ -579,48 +893,98 @@ class AdvancedP7MDecoder:
         
         return None, errors
     
-    def decrypt_p7m_file(self, input_file: Path, output_dir: Path) -> Tuple[bool, Optional[Path], List[str], str]:
-        """Decodifica file P7M con approccio multi-strategia."""
+    def decrypt_p7m_file(self, input_file: Path, output_dir: Optional[Path], file_sha256: Optional[str] = None,
+                         in_memory: bool = False) -> Tuple[bool, Any, List[str], str]:
+        """Decodifica file P7M con approccio multi-strategia.
+        
+        file_sha256, se già calcolato dal chiamante, evita di rileggere il file per la chiave di cache.
+        Con in_memory=True non scrive nulla su disco e restituisce i byte dell'XML al posto del percorso."""
         if not input_file.name.lower().endswith('.p7m'):
             return False, None, ["Non è un file P7M"], "NONE"
         
         all_errors = []
-        output_dir.mkdir(parents=True, exist_ok=True)
-        
-        output_name = input_file.name[:-4] if input_file.name.endswith('.p7m') else input_file.stem
-        output_file = output_dir / output_name
+        output_file = None
+        if not in_memory:
+            output_dir.mkdir(parents=True, exist_ok=True)
+            output_name = input_file.name[:-4] if input_file.name.endswith('.p7m') else input_file.stem
+            output_file = output_dir / output_name
+        
+        def decoded(xml_content):
+            # Secondo elemento del risultato: percorso scritto oppure byte in memoria
+            if output_file is not None:
+                return output_file
+            return xml_content.encode('utf-8') if isinstance(xml_content, str) else bytes(xml_content)
         
         try:
-            p7m_content = input_file.read_bytes()
-            original_size = len(p7m_content)
+            p7m_source = None
+            try:
+                # Stesso P7M già decodificato in precedenza: basta riscrivere l'XML
+                digest = None
+                if self.cache is not None:
+                    digest = file_sha256
+                    if not digest:
+                        p7m_source = self._map_p7m(input_file)
+                        digest = hashlib.sha256(p7m_source).hexdigest()
+                cached = self._cache_lookup(digest)
+                if cached:
+                    xml_content, method = cached
+                    if output_file is not None:
+                        self._write_xml(output_file, xml_content)
+                    self.stats['CACHE_HIT'] += 1
+                    self.logger.debug(f"Decodifica da cache per {input_file.name}")
+                    return True, decoded(xml_content), all_errors, method
+                
+                if p7m_source is None:
+                    p7m_source = self._map_p7m(input_file)
+                # Il formato riconosciuto dai primi byte decide quali strategie hanno senso
+                p7m_kind = self._classify_p7m(p7m_source)
+                # Da qui servono bytes veri: asn1crypto non accetta mmap né memoryview
+                p7m_content = p7m_source[:]
+            finally:
+                if isinstance(p7m_source, mmap.mmap):
+                    p7m_source.close()
+            is_binary = p7m_kind in ('DER', 'UNKNOWN')
             
             # Strategia 1: ASN1Crypto
-            xml_content, asn1_errors = self.extract_xml_from_p7m_asn1(p7m_content)
-            if xml_content:
-                with open(output_file, 'w', encoding='utf-8') as f:
-                    f.write(xml_content)
-                self.logger.debug(f"Decodifica ASN1 riuscita per {input_file.name}")
-                return True, output_file, all_errors, "ASN1"
-            all_errors.extend(asn1_errors)
+            if is_binary:
+                xml_content, asn1_errors = self.extract_xml_from_p7m_asn1(p7m_content)
+                if xml_content:
+                    self._save_decoded(output_file, xml_content, digest, "ASN1")
+                    self.logger.debug(f"Decodifica ASN1 riuscita per {input_file.name}")
+                    return True, decoded(xml_content), all_errors, "ASN1"
+                all_errors.extend(asn1_errors)
+                
+                # DER letto senza errori ma privo di XML incapsulato (es. firma detached): le altre strategie non aiutano
+                if p7m_kind == 'DER' and ASN1_AVAILABLE and not asn1_errors:
+                    all_errors.append("ASN1: nessun contenuto XML incapsulato")
+                    is_binary = False
+                    p7m_kind = 'EMPTY'
             
             # Strategia 2: Windows API (solo su Windows)
-            if platform.system() == "Windows":
+            if is_binary and platform.system() == "Windows":
                 xml_content, win_errors = self.extract_xml_from_p7m_windows(p7m_content)
                 if xml_content:
-                    with open(output_file, 'w', encoding='utf-8') as f:
-                        f.write(xml_content)
+                    self._save_decoded(output_file, xml_content, digest, "WINDOWS_API")
                     self.logger.debug(f"Decodifica Windows API riuscita per {input_file.name}")
-                    return True, output_file, all_errors, "WINDOWS_API"
+                    return True, decoded(xml_content), all_errors, "WINDOWS_API"
                 all_errors.extend(win_errors)
             
-            # Strategia 3: OpenSSL
-            xml_content, openssl_errors = self.extract_xml_from_p7m_openssl(input_file)
-            if xml_content:
-                with open(output_file, 'w', encoding='utf-8') as f:
-                    f.write(xml_content)
-                self.logger.debug(f"Decodifica OpenSSL riuscita per {input_file.name}")
-                return True, output_file, all_errors, "OPENSSL"
-            all_errors.extend(openssl_errors)
+            # Strategia 3: varianti PEM/Base64 in-process con ASN1Crypto
+            if ASN1_AVAILABLE and p7m_kind in ('PEM', 'UNKNOWN'):
+                xml_content, pem_errors = self.extract_xml_from_p7m_pem(p7m_content)
+                if xml_content:
+                    self._save_decoded(output_file, xml_content, digest, "ASN1")
+                    self.logger.debug(f"Decodifica ASN1 (PEM/Base64) riuscita per {input_file.name}")
+                    return True, decoded(xml_content), all_errors, "ASN1"
+                all_errors.extend(pem_errors)
+            elif p7m_kind == 'SMIME' or (not ASN1_AVAILABLE and p7m_kind != 'EMPTY'):
+                # Strategia 3 alternativa: OpenSSL esterno, se ASN1Crypto non è installata o per buste S/MIME
+                xml_content, openssl_errors = self.extract_xml_from_p7m_openssl(input_file, smime=p7m_kind == 'SMIME')
+                if xml_content:
+                    self._save_decoded(output_file, xml_content, digest, "OPENSSL")
+                    self.logger.debug(f"Decodifica OpenSSL riuscita per {input_file.name}")
+                    return True, decoded(xml_content), all_errors, "OPENSSL"
+                all_errors.extend(openssl_errors)
             
         except Exception as e:
             all_errors.append(f"Errore lettura file: {str(e)}")
@@ -629,23 +993,74 @@ class AdvancedP7MDecoder:
         self.logger.warning(f"Decodifica fallita per {input_file.name}")
         return False, None, all_errors, "FAILED"
     
+    def decrypt_p7m_batch(self, input_files: List[Path], output_dir: Path, 
+                          max_workers: Optional[int] = None) -> List[Tuple[bool, Optional[Path], List[str], str]]:
+        """Decodifica più file P7M in parallelo su un pool di processi."""
+        return [result for _, result in self.decrypt_p7m_iter(zip(input_files, repeat(output_dir)), max_workers)]
+    
+    def decrypt_p7m_iter(self, jobs: Iterable[Tuple[Path, Path]], max_workers: Optional[int] = None
+                         ) -> Iterator[Tuple[Path, Tuple[bool, Optional[Path], List[str], str]]]:
+        """Decodifica coppie (file P7M, directory di output) producendo (file, esito) man mano, in ordine.
+        
+        jobs può essere un generatore: i file vengono inviati al pool mentre sono ancora in corso di ricerca."""
+        jobs = iter(jobs)
+        head = list(islice(jobs, 2))
+        if len(head) < 2:
+            for input_file, output_dir in head:
+                yield input_file, self.decrypt_p7m_file(input_file, output_dir)
+            return
+        
+        jobs, logged = tee(chain(head, jobs))
+        with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count(), initializer=_init_p7m_worker) as pool:
+            for (input_file, _), (result, worker_stats) in zip(logged, pool.map(_decrypt_p7m_worker, jobs, chunksize=16)):
+                # Statistiche e log raccolti nel processo principale
+                self.merge_stats(worker_stats)
+                success, _, _, method = result
+                if success:
+                    self.logger.debug(f"Decodifica {method} riuscita per {input_file.name}")
+                else:
+                    self.logger.warning(f"Decodifica fallita per {input_file.name}")
+                yield input_file, result
+    
+    def merge_stats(self, other: Dict[str, int]):
+        """Somma alle statistiche correnti quelle di un altro decoder (es. un worker del pool)."""
+        self.stats.update(other)
+    
     def get_statistics(self) -> Dict[str, int]:
         """Restituisce statistiche di decodifica."""
         return self.stats.copy()
 
+# Logger silenzioso per i processi worker: i messaggi vengono emessi dal processo principale
+_WORKER_LOGGER = logging.getLogger(f"{__name__}.p7m_worker")
+_WORKER_LOGGER.addHandler(logging.NullHandler())
+_WORKER_LOGGER.propagate = False
+
+_WORKER_DECODER: Optional[AdvancedP7MDecoder] = None
+
+def _init_p7m_worker():
+    """Crea un solo decoder, con la sua connessione alla cache, per ogni processo del pool."""
+    global _WORKER_DECODER
+    _WORKER_DECODER = AdvancedP7MDecoder(_WORKER_LOGGER)
+
+def _decrypt_p7m_worker(job: Tuple[Path, Path]) -> Tuple[Tuple[bool, Optional[Path], List[str], str], Dict[str, int]]:
+    """Decodifica un singolo P7M (file, directory di output) in un processo del pool, restituendo esito e statistiche."""
+    input_file, output_dir = job
+    result = _WORKER_DECODER.decrypt_p7m_file(input_file, output_dir)
+    # Solo gli incrementi di questo file: il processo principale li somma con merge_stats
+    stats, _WORKER_DECODER.stats = _WORKER_DECODER.stats, Counter()
+    return result, stats
+
 # --- ANALISI XML AVANZATA ---
 def parse_notification_xml(xml_content: str, filename: str) -> Optional[Dict]:
     """Parser per ricevute SDI e notifiche."""
     try:
-        clean_xml = xml_content[xml_content.find('<?xml'):]
-        it = ET.iterparse(io.StringIO(clean_xml))
-        for _, el in it:
-            if '}' in el.tag:
-                el.tag = el.tag.split('}', 1)[1]
-        root = it.root
-        
-        def get_text(path): 
-            elem = root.find(path)
+        root = parse_xml_string_stripped(xml_content)
+        
+        def get_text(chiave):
+            if LXML_AVAILABLE:
+                elem = _first(_XP_NOTIFICA[chiave](root))
+            else:
+                elem = root.find(_XP_NOTIFICA[chiave])
             return elem.text.strip() if elem is not None and elem.text else None
         
         # Identifica tipo ricevuta
@@ -667,13 +1082,7 @@ def parse_notification_xml(xml_content: str, filename: str) -> Optional[Dict]:
         return {
             "status": "OK",
             "tipo_notifica": tipo,
-            "identificativo_sdi": get_text(".//IdentificativoSdI"),
-            "nome_file": get_text(".//NomeFile"),
-            "hash_file": get_text(".//Hash"),
-            "data_ora_ricezione": get_text(".//DataOraRicezione"),
-            "data_ora_consegna": get_text(".//DataOraConsegna"),
-            "riferimento_fattura": get_text(".//RiferimentoFattura"),
-            "posizione_nella_fattura": get_text(".//PosizioneNellaFattura"),
+            **{chiave: get_text(chiave) for chiave in _CAMPI_NOTIFICA},
             "raw_content": xml_content[:500]  # Prime 500 caratteristiche per debug
         }
         
@@ -704,22 +1113,106 @@ def get_denominazione_or_nome_cognome(node) -> str:
 
     return "Dati anagrafici mancanti"
 
+# Nodi letti in streaming da parse_invoice_xml_advanced: nome -> (nodo padre, percorso relativo).
+# Come find(), ogni nodo è la prima corrispondenza del percorso sotto il padre in ordine di documento.
+_INVOICE_NODES = {
+    'header': ('root', ('FatturaElettronicaHeader',)),
+    'body': ('root', ('FatturaElettronicaBody',)),
+    'cedente': ('header', ('CedentePrestatore',)),
+    'cessionario': ('header', ('CessionarioCommittente',)),
+    'anagrafica_cedente': ('cedente', ('DatiAnagrafici', 'Anagrafica')),
+    'anagrafica_cessionario': ('cessionario', ('DatiAnagrafici', 'Anagrafica')),
+    'dati_generali': ('body', ('DatiGenerali',)),
+    'dati_generali_documento': ('dati_generali', ('DatiGeneraliDocumento',)),
+    'ritenuta': ('dati_generali_documento', ('DatiRitenuta',)),
+    'cassa': ('dati_generali_documento', ('DatiCassaPrevidenziale',)),
+}
+# Campi di testo (nodo, percorso relativo), come findtext() sul nodo
+_INVOICE_TEXTS = frozenset(
+    [(ruolo, campo) for ruolo in ('cedente', 'cessionario')
+     for campo in (('DatiAnagrafici', 'CodiceFiscale'), ('DatiAnagrafici', 'IdFiscaleIVA', 'IdCodice'))]
+    + [(ruolo, (campo,)) for ruolo in ('anagrafica_cedente', 'anagrafica_cessionario')
+       for campo in ('Denominazione', 'Nome', 'Cognome')]
+    + [('dati_generali_documento', (campo,)) for campo in ('Data', 'Numero', 'ImportoTotaleDocumento')]
+    + [('ritenuta', ('ImportoRitenuta',)), ('ritenuta', ('TipoRitenuta',)),
+       ('cassa', ('ImportoContributoCassa',))]
+)
+_INVOICE_NODE_BY_PATH = {percorso: nome for nome, percorso in _INVOICE_NODES.items()}
+# Per ogni nodo, i prefissi dei percorsi che portano a un campo o a un nodo figlio: il resto viene ignorato
+_INVOICE_PREFIXES: Dict[str, Set[Tuple[str, ...]]] = {}
+for _nodo, _rel in list(_INVOICE_NODES.values()) + list(_INVOICE_TEXTS):
+    _INVOICE_PREFIXES.setdefault(_nodo, set()).update(_rel[:i] for i in range(1, len(_rel) + 1))
+
+def _scan_invoice_xml(xml_content: str) -> Tuple[Dict[Tuple[str, Tuple[str, ...]], Optional[str]], Dict[str, int]]:
+    """Legge in streaming solo i campi usati da parse_invoice_xml_advanced.
+    
+    Restituisce il testo dei campi e il numero di figli dei nodi trovati; si ferma appena
+    header e primo body sono chiusi (gli altri body di un lotto non servono)."""
+    # Il testo è già decodificato: con lxml la dichiarazione (con il suo encoding) va tolta prima di ricodificare
+    clean_xml = _xml_body(xml_content, LXML_AVAILABLE)
+    if LXML_AVAILABLE:
+        events = LET.iterparse(io.BytesIO(clean_xml.encode('utf-8')), events=('start', 'end'),
+                               resolve_entities=False, no_network=True)
+    else:
+        events = ET.iterparse(io.StringIO(clean_xml), events=('start', 'end'))
+    
+    testi = {}
+    figli = {}
+    trovati = set()
+    contesti = []   # per ogni elemento aperto: coppie (nodo, percorso relativo) ancora utili
+    for event, elem in events:
+        if event == 'start':
+            tag = elem.tag.rpartition('}')[2]
+            if not contesti:
+                contesto = [('root', ())]
+            else:
+                contesto = [(nodo, rel + (tag,)) for nodo, rel in contesti[-1]
+                            if rel + (tag,) in _INVOICE_PREFIXES[nodo]]
+                for chiave in list(contesto):
+                    nome = _INVOICE_NODE_BY_PATH.get(chiave)
+                    if nome is not None and nome not in trovati:
+                        trovati.add(nome)
+                        contesto.append((nome, ()))
+            contesti.append(contesto)
+            continue
+        
+        for chiave in contesti.pop():
+            nodo, rel = chiave
+            if not rel:
+                figli[nodo] = len(elem)
+            elif chiave in _INVOICE_TEXTS and chiave not in testi:
+                testi[chiave] = elem.text
+        if 'header' in figli and 'body' in figli:
+            break
+        elem.clear()
+    return testi, figli
+
+def _denominazione_da_testi(testi: Dict[Tuple[str, Tuple[str, ...]], Optional[str]], figli: Dict[str, int],
+                            anagrafica: str) -> str:
+    # Stessa logica di get_denominazione_or_nome_cognome, sui campi letti in streaming
+    if anagrafica not in figli:
+        return "Dati anagrafici mancanti"
+    denominazione = testi.get((anagrafica, ('Denominazione',)))
+    if denominazione:
+        return denominazione.strip()
+    if (anagrafica, ('Nome',)) in testi and (anagrafica, ('Cognome',)) in testi:
+        nome_text = (testi[(anagrafica, ('Nome',))] or "").strip()
+        cognome_text = (testi[(anagrafica, ('Cognome',))] or "").strip()
+        if nome_text and cognome_text:
+            return f"{nome_text} {cognome_text}"
+    return "Dati anagrafici mancanti"
+
 def parse_invoice_xml_advanced(xml_content: str) -> Optional[Dict]:
     """Parser XML fattura con estrazione completa dati."""
     try:
-        clean_xml = xml_content[xml_content.find('<?xml'):]
-        it = ET.iterparse(io.StringIO(clean_xml))
-        for _, el in it:
-            if '}' in el.tag:
-                el.tag = el.tag.split('}', 1)[1]
-        root = it.root
-        
-        def get_text(path): 
-            elem = root.find(path)
-            return elem.text.strip() if elem is not None and elem.text else None
+        testi, figli = _scan_invoice_xml(xml_content)
+        
+        def get_text(nodo, *percorso):
+            text = testi.get((nodo, percorso))
+            return text.strip() if text else None
         
-        def get_float(path):
-            text = get_text(path)
+        def get_float(nodo, *percorso):
+            text = get_text(nodo, *percorso)
             if text:
                 try:
                     return float(text.replace(',', '.'))
@@ -727,37 +1220,26 @@ def parse_invoice_xml_advanced(xml_content: str) -> Optional[Dict]:
                     return 0.0
             return 0.0
         
-        # Estrae dati anagrafici
-        header = root.find('FatturaElettronicaHeader')
-        if not header:
+        # Header, cedente, cessionario e body devono esistere e non essere vuoti
+        if not all(figli.get(nodo) for nodo in ('header', 'cedente', 'cessionario', 'body')):
             return None
-            
-        cedente = header.find('CedentePrestatore')
-        cessionario = header.find('CessionarioCommittente')
-        body = root.find('FatturaElettronicaBody')
-        
-        if not all([cedente, cessionario, body]):
+        if 'dati_generali_documento' not in figli:
             return None
-            
-        dati_generali = body.find('DatiGenerali')
-        dati_generali_documento = dati_generali.find('DatiGeneraliDocumento')
         
         # Dati cedente
-        cedente_anagrafica = cedente.find('DatiAnagrafici/Anagrafica')
-        cedente_denominazione = get_denominazione_or_nome_cognome(cedente_anagrafica)
-        cedente_id_fiscale = get_text(".//CedentePrestatore/DatiAnagrafici/CodiceFiscale") or "N/D"
-        cedente_partita_iva = get_text(".//CedentePrestatore/DatiAnagrafici/IdFiscaleIVA/IdCodice") or "N/D"
+        cedente_denominazione = _denominazione_da_testi(testi, figli, 'anagrafica_cedente')
+        cedente_id_fiscale = get_text('cedente', 'DatiAnagrafici', 'CodiceFiscale') or "N/D"
+        cedente_partita_iva = get_text('cedente', 'DatiAnagrafici', 'IdFiscaleIVA', 'IdCodice') or "N/D"
         
         # Dati cessionario
-        cessionario_anagrafica = cessionario.find('DatiAnagrafici/Anagrafica')
-        cessionario_denominazione = get_denominazione_or_nome_cognome(cessionario_anagrafica)
-        cessionario_id_fiscale = get_text(".//CessionarioCommittente/DatiAnagrafici/CodiceFiscale") or "N/D"
-        cessionario_partita_iva = get_text(".//CessionarioCommittente/DatiAnagrafici/IdFiscaleIVA/IdCodice") or "N/D"
+        cessionario_denominazione = _denominazione_da_testi(testi, figli, 'anagrafica_cessionario')
+        cessionario_id_fiscale = get_text('cessionario', 'DatiAnagrafici', 'CodiceFiscale') or "N/D"
+        cessionario_partita_iva = get_text('cessionario', 'DatiAnagrafici', 'IdFiscaleIVA', 'IdCodice') or "N/D"
         
         # Dati generali fattura
-        invoice_date_str = get_text(".//DatiGeneraliDocumento/Data")
-        invoice_number = get_text(".//DatiGeneraliDocumento/Numero") or "N/D"
-        total_amount = get_float(".//ImportoTotaleDocumento")
+        invoice_date_str = get_text('dati_generali_documento', 'Data')
+        invoice_number = get_text('dati_generali_documento', 'Numero') or "N/D"
+        total_amount = get_float('dati_generali_documento', 'ImportoTotaleDocumento')
         
         # Parsing data
         invoice_date = None
@@ -770,21 +1252,19 @@ def parse_invoice_xml_advanced(xml_content: str) -> Optional[Dict]:
                 pass
         
         # Dati ritenute avanzati
-        ritenuta_node = dati_generali_documento.find('DatiRitenuta')
-        has_ritenuta = ritenuta_node is not None
+        has_ritenuta = 'ritenuta' in figli
         importo_ritenuta = 0.0
         tipo_ritenuta = "N/D"
         
         if has_ritenuta:
-            importo_ritenuta = get_float(".//DatiRitenuta/ImportoRitenuta")
-            tipo_ritenuta = get_text(".//DatiRitenuta/TipoRitenuta") or "N/D"
+            importo_ritenuta = get_float('ritenuta', 'ImportoRitenuta')
+            tipo_ritenuta = get_text('ritenuta', 'TipoRitenuta') or "N/D"
         
         # Dati cassa previdenziale
-        cassa_node = dati_generali_documento.find('DatiCassaPrevidenziale')
-        has_cassa = cassa_node is not None
+        has_cassa = 'cassa' in figli
         importo_cassa = 0.0
         if has_cassa:
-            importo_cassa = get_float(".//DatiCassaPrevidenziale/ImportoContributoCassa")
+            importo_cassa = get_float('cassa', 'ImportoContributoCassa')
         
         return {
             'invoice_number': invoice_number,
@@ -809,40 +1289,79 @@ def parse_invoice_xml_advanced(xml_content: str) -> Optional[Dict]:
 
 # --- GESTIONE DUPLICATI AVANZATA ---
 class AdvancedDuplicateManager:
-    """Gestione avanzata duplicati con hash multipli e contenuto."""
+    """Gestione avanzata duplicati con hash del file e del contenuto."""
     
     def __init__(self):
         self.processed_files = {}
-        self.content_hashes = set()
+        # Hash del contenuto come interi a 64 bit: meno della metà della memoria delle stringhe esadecimali
+        self.content_hashes: Set[int] = set()
+        # (dimensione, hash dei primi 64 KiB) -> chiavi dei file registrati senza hash completo
+        self.prefilter: Dict[Tuple[int, int], List[str]] = {}
+    
+    @staticmethod
+    def _prefilter_key(file_path: Path) -> Optional[Tuple[int, int]]:
+        try:
+            with open(file_path, 'rb') as f:
+                head = f.read(DUPLICATE_PREFILTER_BYTES)
+                size = os.fstat(f.fileno()).st_size
+        except OSError:
+            return None
+        return size, xxhash.xxh32_intdigest(head) if XXHASH_AVAILABLE else zlib.crc32(head)
+    
+    def _register(self, file_path: Path, file_hash: Optional[str], content_hash: str) -> str:
+        composite_key = f"{file_hash}_{content_hash}" if file_hash is not None else f"pending_{file_path}"
+        self.processed_files[composite_key] = {
+            'file_path': str(file_path),
+            'file_hash': file_hash,
+            'hash_algorithm': DUPLICATE_HASH_ALGORITHM,
+            'content_hash': content_hash,
+            'processed_at': now_iso()
+        }
+        self.content_hashes.add(int(content_hash, 16))
+        return composite_key
+    
+    def _resolve_pending(self, pending_keys: List[str]):
+        # I file registrati senza hash completo lo ricevono solo alla prima collisione sul prefiltro
+        for pending_key in pending_keys:
+            record = self.processed_files.pop(pending_key)
+            record['file_hash'] = calculate_file_hash(Path(record['file_path']), DUPLICATE_HASH_ALGORITHM)
+            self.processed_files.setdefault(f"{record['file_hash']}_{record['content_hash']}", record)
+        pending_keys.clear()
         
     def is_duplicate(self, file_path: Path, xml_content: str) -> Tuple[bool, str]:
         """Verifica duplicati usando hash file e contenuto."""
-        file_hash_md5 = calculate_file_hash(file_path, 'md5')
-        file_hash_sha256 = calculate_file_hash(file_path, 'sha256')
-        content_hash = calculate_content_hash(xml_content)
+        return self.is_duplicate_hash(file_path, calculate_content_hash(xml_content))
+    
+    def is_duplicate_hash(self, file_path: Path, content_hash: str) -> Tuple[bool, str]:
+        """Come is_duplicate, con l'hash del contenuto già calcolato (es. in un processo del pool)."""
+        prefilter_key = self._prefilter_key(file_path)
+        pending_keys = self.prefilter.get(prefilter_key)
+        if prefilter_key is not None and pending_keys is None:
+            # Dimensione e primi 64 KiB mai visti: nessun file identico già registrato, l'hash completo non serve
+            if int(content_hash, 16) in self.content_hashes:
+                return True, f"content_{content_hash}"
+            composite_key = self._register(file_path, None, content_hash)
+            self.prefilter[prefilter_key] = [composite_key]
+            return False, composite_key
+        if pending_keys:
+            self._resolve_pending(pending_keys)
+        
+        # Una sola lettura del file: nessun avversario, basta un hash veloce non crittografico
+        file_hash = calculate_file_hash(file_path, DUPLICATE_HASH_ALGORITHM)
         
         # Crea chiave composta
-        composite_key = f"{file_hash_sha256}_{content_hash}"
+        composite_key = f"{file_hash}_{content_hash}"
         
         # Verifica duplicati
         if composite_key in self.processed_files:
             return True, composite_key
         
         # Verifica anche solo contenuto normalizzato
-        if content_hash in self.content_hashes:
+        if int(content_hash, 16) in self.content_hashes:
             return True, f"content_{content_hash}"
         
         # Registra come processato
-        self.processed_files[composite_key] = {
-            'file_path': str(file_path),
-            'file_hash_md5': file_hash_md5,
-            'file_hash_sha256': file_hash_sha256,
-            'content_hash': content_hash,
-            'processed_at': datetime.now().isoformat()
-        }
-        self.content_hashes.add(content_hash)
-        
-        return False, composite_key
+        return False, self._register(file_path, file_hash, content_hash)
     
     def get_statistics(self) -> Dict[str, int]:
         """Restituisce statistiche duplicati."""
@@ -943,7 +1462,8 @@ class ConfigManager:
                 "download_metadati": True,
                 "download_ricevute_sdi": True,
                 "decodifica_p7m": True,
-                "pausa_tra_download": 0.5
+                "pausa_tra_download": 0.5,
+                "download_paralleli": DOWNLOAD_CONCURRENCY
             },
             "configurazione_decodifica": {
                 "metodi_abilitati": {
@@ -966,7 +1486,8 @@ class ConfigManager:
                 "attiva": True,
                 "cleanup_temp": True,
                 "genera_report": True,
-                "gestione_duplicati_avanzata": True
+                "gestione_duplicati_avanzata": True,
+                "per_file_json": False
             },
             "logging": {
                 "livello": "INFO",
@@ -1007,6 +1528,13 @@ class ConfigManager:
         clients = self.config.get('portfolio_clienti', {})
         return {k: v for k, v in clients.items() if v.get('attivo', True)}
 
+def dump_json_bytes(data, indent: bool = True) -> bytes:
+    """JSON in UTF-8 (indentato o su una riga); con orjson date e dataclass passano da str() come con json.dump(default=str)."""
+    if ORJSON_AVAILABLE:
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+        return orjson.dumps(data, default=str, option=option | orjson.OPT_INDENT_2 if indent else option)
+    return json.dumps(data, ensure_ascii=False, indent=2 if indent else None, default=str).encode('utf-8')
+
 # --- ORGANIZZATORE FILE AVANZATO ---
 class AdvancedFileOrganizer:
     def __init__(self, config: Dict, logger: logging.Logger):
@@ -1016,6 +1544,68 @@ class AdvancedFileOrganizer:
         self.duplicate_manager = AdvancedDuplicateManager()
         self.output_base = Path(config['directory_sistema']['output_base'])
         self.clients_config = config.get('portfolio_clienti', {})
+        # Strutture già create per (cliente, tipo, anno): le directory si creano una sola volta
+        self._structures: Dict[Tuple[str, str, int], Dict[str, Path]] = {}
+        # Metadati accodati a un _index.jsonl per directory json; i singoli .json solo se richiesti
+        self.per_file_json = config.get('elaborazione', {}).get('per_file_json', False)
+        self._metadata_logs: Dict[Path, BinaryIO] = {}
+        # Manifest dei file già organizzati: nelle esecuzioni successive quelli invariati non vengono rielaborati
+        self.manifest_file = self.output_base / MANIFEST_FILE_NAME
+        self.manifest = self._load_manifest()
+    
+    def _load_manifest(self) -> Dict[str, Dict]:
+        try:
+            with open(self.manifest_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            self.logger.warning(f"Manifest non leggibile, verrà ricreato: {e}")
+            return {}
+    
+    def save_manifest(self):
+        """Salva il manifest in modo atomico (file temporaneo + rename)."""
+        try:
+            self.manifest_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_file = self.manifest_file.with_suffix('.tmp')
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(self.manifest, f, ensure_ascii=False)
+            os.replace(tmp_file, self.manifest_file)
+        except Exception as e:
+            self.logger.warning(f"Salvataggio manifest fallito: {e}")
+    
+    def _append_metadata_log(self, json_dir: Path, metadata: Dict):
+        handle = self._metadata_logs.get(json_dir)
+        if handle is None:
+            handle = self._metadata_logs[json_dir] = open(json_dir / METADATA_LOG_NAME, 'ab')
+        handle.write(dump_json_bytes(metadata, indent=False) + b'\n')
+    
+    def close_metadata_logs(self):
+        """Chiude i file _index.jsonl aperti durante l'elaborazione."""
+        for handle in self._metadata_logs.values():
+            try:
+                handle.close()
+            except OSError as e:
+                self.logger.warning(f"Chiusura indice metadati fallita: {e}")
+        self._metadata_logs.clear()
+    
+    def _remember_processed(self, file_path: Path, result: AdvancedProcessingResult):
+        # Dimensione e mtime letti da analyze_file_advanced: se il file è cambiato nel frattempo
+        # l'impronta non corrisponde più e alla prossima esecuzione viene rielaborato
+        size, mtime_ns = result.original_size, result.original_mtime_ns
+        if not mtime_ns:
+            try:
+                st = file_path.stat()
+            except OSError:
+                return
+            size, mtime_ns = st.st_size, st.st_mtime_ns
+        self.manifest[str(file_path.resolve())] = {
+            'size': size,
+            'mtime_ns': mtime_ns,
+            'hash_sha256': result.hash_sha256,
+            'hash_md5': result.hash_md5,
+            'file_type': result.file_type
+        }
     
     def get_client_name(self, client_id: str) -> str:
         client_data = self.clients_config.get(client_id, {})
@@ -1035,6 +1625,11 @@ class AdvancedFileOrganizer:
     
     def create_client_structure(self, client_name: str, file_type: str, anno: int) -> Dict[str, Path]:
         normalized_type = self.normalize_file_type(file_type)
+        key = (client_name, normalized_type, anno)
+        structure = self._structures.get(key)
+        if structure is not None:
+            return structure
+        
         base_path = self.output_base / client_name / normalized_type / str(anno)
         
         structure = {
@@ -1049,55 +1644,93 @@ class AdvancedFileOrganizer:
         for dir_path in structure.values():
             dir_path.mkdir(parents=True, exist_ok=True)
         
+        self._structures[key] = structure
         return structure
     
-    def process_single_file_advanced(self, file_path: Path, is_temp: bool = False) -> Tuple[AdvancedProcessingResult, Optional[Dict]]:
-        """Processa singolo file con sistema avanzato."""
+    def process_single_file_advanced(self, file_path: Path, is_temp: bool = False) -> Tuple[AdvancedProcessingResult, Optional[Dict], Optional[str]]:
+        """Processa singolo file con sistema avanzato; restituisce anche l'XML estratto, da passare al salvataggio."""
+        return self.apply_duplicate_check(file_path, *self.analyze_file_advanced(file_path))
+    
+    def apply_duplicate_check(self, file_path: Path, result: AdvancedProcessingResult, parsed_data: Optional[Dict],
+                              content_hash: Optional[str], xml_content: Optional[str]
+                              ) -> Tuple[AdvancedProcessingResult, Optional[Dict], Optional[str]]:
+        """Controllo duplicati sul risultato di analyze_file_advanced; va eseguito nel processo principale."""
+        if content_hash is not None and self.config.get('elaborazione', {}).get('gestione_duplicati_avanzata', True):
+            is_dup, dup_key = self.duplicate_manager.is_duplicate_hash(file_path, content_hash)
+            if is_dup:
+                result.status = "SKIPPED"
+                result.is_duplicate = True
+                result.error_message = f"Duplicato: {dup_key[:32]}..."
+                # Anche i duplicati vanno nel manifest: l'originale sarà saltato nelle prossime esecuzioni
+                # e non potrebbe più farli riconoscere come tali
+                self._remember_processed(file_path, result)
+                return result, None, None
+        return result, parsed_data, xml_content
+    
+    def analyze_file_advanced(self, file_path: Path) -> Tuple[AdvancedProcessingResult, Optional[Dict], Optional[str], Optional[str]]:
+        """Hash, decodifica e parsing senza toccare lo stato condiviso: eseguibile in un processo del pool.
+        
+        Restituisce anche l'hash del contenuto normalizzato e l'XML estratto, None se il file non è stato decodificato."""
+        content_hash = None
+        xml_content = None
         result = AdvancedProcessingResult(
             file_name=file_path.name, 
             status="KO", 
-            method_used="NONE",
-            original_size=file_path.stat().st_size if file_path.exists() else 0
+            method_used="NONE"
         )
         
         try:
-            # Determina tipo file
-            file_type = determine_file_type(file_path)
+            # Una sola stat() per file: dimensione e mtime servono a manifest, cache degli hash e risultato
+            st = file_path.stat()
+            result.original_size = st.st_size
+            result.original_mtime_ns = st.st_mtime_ns
+            
+            # Già organizzato in un'esecuzione precedente e invariato (dimensione e mtime): niente hash né parsing
+            entry = self.manifest.get(str(file_path.resolve()))
+            if entry is not None:
+                if entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns:
+                    result.status = "SKIPPED"
+                    result.file_type = entry.get('file_type')
+                    result.hash_md5 = entry.get('hash_md5')
+                    result.hash_sha256 = entry.get('hash_sha256')
+                    result.error_message = "Già elaborato (file invariato)"
+                    return result, None, content_hash, xml_content
+            
+            # Determina tipo file: estensione calcolata una sola volta per file
+            ext = file_path.suffix.lower()
+            file_type = determine_file_type(file_path, ext)
             result.file_type = file_type
             
             if file_type == "UNSUPPORTED":
                 result.status = "SKIPPED"
                 result.error_message = "Tipo file non supportato"
-                return result, None
+                return result, None, content_hash, xml_content
             
             # Calcola hash
-            result.hash_md5 = calculate_file_hash(file_path, 'md5')
-            result.hash_sha256 = calculate_file_hash(file_path, 'sha256')
+            # Una sola lettura per tutti gli hash, compreso quello usato poi dal controllo duplicati
+            hashes = multi_hash(file_path, tuple(dict.fromkeys(('md5', 'sha256', DUPLICATE_HASH_ALGORITHM))), st=st)
+            result.hash_md5 = hashes['md5']
+            result.hash_sha256 = hashes['sha256']
             
             # Estrae XML
-            xml_content = None
             decoding_method = "NONE"
             
-            if file_path.suffix.lower() == '.p7m':
-                # Usa decodifica avanzata
-                temp_dir = file_path.parent / 'temp_decode'
-                success, decoded_file, errors, method = self.decoder.decrypt_p7m_file(file_path, temp_dir)
+            if ext == '.p7m':
+                # Usa decodifica avanzata, in memoria: niente file temporaneo da scrivere, rileggere e cancellare
+                # SHA-256 appena calcolato (o letto dalla cache degli hash): il decoder non rilegge il file per la sua cache
+                success, xml_bytes, errors, method = self.decoder.decrypt_p7m_file(file_path, None, result.hash_sha256,
+                                                                                   in_memory=True)
                 
                 result.decoding_attempts = [method] if method != "FAILED" else ["ASN1_FAILED", "WINDOWS_API_FAILED", "OPENSSL_FAILED"]
                 
-                if success and decoded_file and decoded_file.exists():
-                    xml_content = decoded_file.read_text(encoding='utf-8', errors='ignore')
+                if success and xml_bytes is not None:
+                    # Stesso testo di read_text: newline universali compresi
+                    xml_content = xml_bytes.decode('utf-8', errors='ignore').replace('\r\n', '\n').replace('\r', '\n')
                     decoding_method = method
-                    result.decoded_size = decoded_file.stat().st_size
-                    
-                    # Cleanup temp
-                    try:
-                        shutil.rmtree(temp_dir)
-                    except:
-                        pass
+                    result.decoded_size = len(xml_bytes)
                 else:
                     result.error_message = f"Decodifica P7M fallita: {'; '.join(errors[:3])}"
-                    return result, None
+                    return result, None, content_hash, xml_content
             else:
                 xml_content = file_path.read_text(encoding='utf-8', errors='ignore')
                 decoding_method = "DIRECT_XML"
@@ -1105,14 +1738,8 @@ class AdvancedFileOrganizer:
             
             result.method_used = decoding_method
             
-            # Controlla duplicati
-            if self.config.get('elaborazione', {}).get('gestione_duplicati_avanzata', True):
-                is_dup, dup_key = self.duplicate_manager.is_duplicate(file_path, xml_content)
-                if is_dup:
-                    result.status = "SKIPPED"
-                    result.is_duplicate = True
-                    result.error_message = f"Duplicato: {dup_key[:32]}..."
-                    return result, None
+            # Il controllo duplicati vero e proprio avviene in apply_duplicate_check
+            content_hash = calculate_content_hash(xml_content)
             
             # Parsing specifico per tipo
             parsed_data = None
@@ -1124,7 +1751,7 @@ class AdvancedFileOrganizer:
                     result.company_name = "RICEVUTE_SDI"
                 else:
                     result.error_message = "Parsing ricevuta fallito"
-                    return result, None
+                    return result, None, content_hash, xml_content
                     
             elif file_type == "METADATA":
                 # Metadati - salva direttamente
@@ -1142,15 +1769,15 @@ class AdvancedFileOrganizer:
                     result.importo_ritenuta = invoice_data.get('importo_ritenuta', 0.0)
                 else:
                     result.error_message = "Parsing fattura fallito o non del portfolio"
-                    return result, None
+                    return result, None, content_hash, xml_content
             
             result.status = "OK"
-            return result, parsed_data
+            return result, parsed_data, content_hash, xml_content
             
         except Exception as e:
             result.error_message = f"Errore elaborazione: {str(e)}"
             self.logger.error(f"Errore elaborazione {file_path.name}: {e}")
-            return result, None
+            return result, None, content_hash, xml_content
     
     def save_organized_file_advanced(self, file_path: Path, xml_content: str, parsed_data: Dict, 
                                    result: AdvancedProcessingResult, client_name: str = None) -> bool:
@@ -1195,26 +1822,27 @@ class AdvancedFileOrganizer:
                     "file_hash_sha256": result.hash_sha256,
                     "original_size": result.original_size,
                     "decoded_size": result.decoded_size,
-                    "processed_at": datetime.now(timezone.utc).isoformat()
+                    "processed_at": now_iso(utc=True)
                 },
                 "parsedData": parsed_data
             }
             
-            # Salva JSON
-            json_path = structure['json'] / f"{base_name}.json"
-            with open(json_path, 'w', encoding='utf-8') as f:
-                json.dump(metadata, f, ensure_ascii=False, indent=2, default=str)
+            # Salva JSON: una riga nell'indice della directory, il file singolo solo se configurato
+            self._append_metadata_log(structure['json'], metadata)
+            if self.per_file_json:
+                json_path = structure['json'] / f"{base_name}.json"
+                json_path.write_bytes(dump_json_bytes(metadata))
             
             # Salva XML decodificato
             xml_path = structure['xml_decodificati'] / f"{base_name}.xml"
-            with open(xml_path, 'w', encoding='utf-8') as f:
-                f.write(xml_content)
+            xml_path.write_bytes(xml_content.encode('utf-8'))
             
             # Salva originale se P7M
             if file_path.suffix.lower() == '.p7m':
                 orig_path = structure['p7m_originali'] / file_path.name
                 shutil.copy2(file_path, orig_path)
             
+            self._remember_processed(file_path, result)
             self.logger.info(f"[OK] Organizzato: {client_name}/{year}/{result.file_type}/{base_name}")
             return True
             
@@ -1225,10 +1853,21 @@ class AdvancedFileOrganizer:
     def organize_downloaded_files(self, download_results: Dict[str, List[DownloadResult]], 
                                  decode: bool = True) -> OrganizationResult:
         result = OrganizationResult(success=True)
+        analyses = None
         
         try:
             total_files = sum(len(results) for results in download_results.values())
             
+            # Hash, decodifica e parsing in parallelo; duplicati e salvataggio restano nel processo principale
+            analyses = self.analyze_files_parallel([
+                download_result.file_path
+                for results in download_results.values()
+                for download_result in results
+                if download_result.success and download_result.file_path
+            ])
+            
+            # Barra aggiornata a blocchi di PROGRESS_UPDATE_EVERY file invece che a ogni file
+            pending_updates = 0
             with tqdm(total=total_files, desc="Organizzazione Avanzata", unit="file") as pbar:
                 for client_id, results in download_results.items():
                     client_name = self.get_client_name(client_id)
@@ -1237,12 +1876,12 @@ class AdvancedFileOrganizer:
                     for download_result in results:
                         if download_result.success and download_result.file_path:
                             # Processa con sistema avanzato
-                            proc_result, parsed_data = self.process_single_file_advanced(download_result.file_path)
+                            proc_result, parsed_data, xml_content = self.apply_duplicate_check(download_result.file_path, *next(analyses))
                             
                             if proc_result.status == "OK" and parsed_data:
                                 success = self.save_organized_file_advanced(
                                     download_result.file_path, 
-                                    "", # XML content dovrebbe essere estratto qui
+                                    xml_content,
                                     parsed_data,
                                     proc_result,
                                     client_name
@@ -1252,23 +1891,49 @@ class AdvancedFileOrganizer:
                                     result.organized_files += 1
                                     # Aggiorna statistiche decodifica
                                     if proc_result.method_used != "NONE":
-                                        result.decoding_stats[proc_result.method_used] = result.decoding_stats.get(proc_result.method_used, 0) + 1
+                                        result.decoding_stats[proc_result.method_used] += 1
                                 else:
                                     result.errors.append(f"Errore salvataggio {download_result.file_path.name}")
-                            else:
+                            elif proc_result.status != "SKIPPED":
                                 result.errors.append(f"Errore elaborazione {download_result.file_path.name}: {proc_result.error_message}")
                         
-                        pbar.update(1)
+                        pending_updates += 1
+                        if pending_updates >= PROGRESS_UPDATE_EVERY:
+                            pbar.update(pending_updates)
+                            pending_updates = 0
                     
                     result.client_folders_created[client_id] = client_folders
+                pbar.update(pending_updates)
             
+            self.save_manifest()
             return result
             
         except Exception as e:
             result.success = False
             result.errors.append(str(e))
             return result
-
+        finally:
+            # Pool di analisi e indici chiusi qui, anche se il ciclo si interrompe con un errore
+            if analyses is not None:
+                analyses.close()
+            self.close_metadata_logs()
+
+    def analyze_files_parallel(self, file_paths: List[Path], max_workers: Optional[int] = None):
+        """Esegue analyze_file_advanced su un pool di processi, producendo i risultati nell'ordine dei file."""
+        if len(file_paths) < 2:
+            yield from map(self.analyze_file_advanced, file_paths)
+            return
+        
+        pool = ProcessPoolExecutor(max_workers=max_workers or os.cpu_count(),
+                                   initializer=_init_organizer_worker, initargs=(self.config,))
+        try:
+            for *analysis, worker_stats in pool.map(_analyze_file_worker, file_paths, chunksize=8):
+                self.decoder.merge_stats(worker_stats)
+                yield tuple(analysis)
+        finally:
+            # Chiuso dal chiamante prima della fine: le analisi non ancora avviate vengono annullate
+            pool.shutdown(wait=True, cancel_futures=True)
+    
     def get_processing_statistics(self) -> Dict:
         """Restituisce statistiche complete di elaborazione."""
         decoder_stats = self.decoder.get_statistics()
@@ -1280,6 +1945,20 @@ class AdvancedFileOrganizer:
             "total_methods": sum(decoder_stats.values())
         }
 
+_WORKER_ORGANIZER: Optional[AdvancedFileOrganizer] = None
+
+def _init_organizer_worker(config: Dict):
+    """Crea un solo organizer (con decoder, cache e manifest) per ogni processo del pool."""
+    global _WORKER_ORGANIZER
+    _WORKER_ORGANIZER = AdvancedFileOrganizer(config, _WORKER_LOGGER)
+
+def _analyze_file_worker(file_path: Path) -> Tuple[AdvancedProcessingResult, Optional[Dict], Optional[str], Optional[str], Dict[str, int]]:
+    """Analizza un file in un processo del pool, restituendo anche gli incrementi delle statistiche del decoder."""
+    result, parsed_data, content_hash, xml_content = _WORKER_ORGANIZER.analyze_file_advanced(file_path)
+    decoder = _WORKER_ORGANIZER.decoder
+    stats, decoder.stats = decoder.stats, Counter()
+    return result, parsed_data, content_hash, xml_content, stats
+
 # --- DOWNLOADER ADE (INVARIATO) ---
 class CompleteAdeDownloader:
     def __init__(self, config: Dict, logger: logging.Logger):
@@ -1291,9 +1970,23 @@ class CompleteAdeDownloader:
         self.temp_dir = Path(config['directory_sistema']['input_temp'])
         self.temp_dir.mkdir(parents=True, exist_ok=True)
         self.download_config = config.get('configurazione_download', {})
+        self.max_parallel_downloads = max(1, int(self.download_config.get('download_paralleli', DOWNLOAD_CONCURRENCY)))
+        # Tipi di documento da scaricare, letti una volta dalla configurazione
+        tipi_docs = self.download_config.get('tipi_documenti', {})
+        self.tipi_download = [tipo for chiave, tipo in (('fatture_emesse', 'emesse'),
+                                                        ('fatture_ricevute', 'ricevute_ricezione'),
+                                                        ('fatture_passive', 'passive'))
+                              if tipi_docs.get(chiave, True)]
 
     def create_session(self) -> requests.Session:
         session = requests.Session()
+        # Una connessione keep-alive per ogni download parallelo più una per ogni lista in corso (periodi e tipi
+        # procedono insieme): con un pool più piccolo urllib3 scarterebbe le connessioni in eccesso, rifacendo l'handshake TLS.
+        # Errori transitori del portale ritentati con backoff (solo metodi idempotenti: il login in POST no);
+        # esauriti i tentativi si restituisce l'ultima risposta, come prima
+        retry = Retry(total=3, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=2 * self.max_parallel_downloads, max_retries=retry)
+        session.mount('https://', adapter)
         session.headers.update({
             'User-Agent': DEFAULT_USER_AGENT,
             'Connection': 'keep-alive',
@@ -1328,11 +2021,12 @@ class CompleteAdeDownloader:
                 data=payload, verify=False, timeout=30
             )
 
-            liferay_matches = re.findall(r"Liferay\.authToken\s*=\s*'([^']+)';", r.text)
-            if not liferay_matches:
+            # Ricerca sui byte della pagina: niente decodifica dell'intero HTML, si ferma al primo token
+            liferay_match = _RE_LIFERAY_TOKEN.search(r.content)
+            if not liferay_match:
                 raise Exception("Token non trovato")
 
-            self.p_auth = liferay_matches[0]
+            self.p_auth = liferay_match.group(1).decode('ascii')
 
             r = self.session.get(f'https://ivaservizi.agenziaentrate.gov.it/dp/api?v={unix_timestamp()}', timeout=30)
             if r.status_code != 200:
@@ -1409,23 +2103,29 @@ class CompleteAdeDownloader:
             file_type_param = "FILE_FATTURA" if file_type == "fattura" else "FILE_METADATI"
             url = f'https://ivaservizi.agenziaentrate.gov.it/cons/cons-services/rs/fatture/file/{fattura_file}?tipoFile={file_type_param}&download=1&v={unix_timestamp()}'
 
-            r = self.session.get(url, headers=self.headers_token, stream=True, timeout=60)
-
-            if r.status_code != 200:
-                return None
+            # Risposta in streaming chiusa anche sulle uscite anticipate: la connessione torna subito al pool
+            with self.session.get(url, headers=self.headers_token, stream=True, timeout=60) as r:
+                if r.status_code != 200:
+                    return None
 
-            content_disp = r.headers.get('content-disposition', '')
-            fname = _parse_filename_from_content_disposition(content_disp)
+                content_disp = r.headers.get('content-disposition', '')
+                fname = _parse_filename_from_content_disposition(content_disp)
 
-            if not fname:
-                return None
+                if not fname:
+                    return None
 
-            file_path = output_dir / fname
+                file_path = output_dir / fname
 
-            with open(file_path, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
+                # Copia diretta dal socket a blocchi da 1 MiB; decode_content mantiene la decompressione gzip di iter_content
+                r.raw.decode_content = True
+                try:
+                    f = open(file_path, 'wb')
+                except FileNotFoundError:
+                    # Directory creata solo al primo file effettivamente scaricato: niente cartelle vuote
+                    output_dir.mkdir(parents=True, exist_ok=True)
+                    f = open(file_path, 'wb')
+                with f:
+                    shutil.copyfileobj(r.raw, f, length=DOWNLOAD_BUFFER_SIZE)
 
             return file_path
 
@@ -1433,8 +2133,33 @@ class CompleteAdeDownloader:
             self.logger.error(f"Errore download {fattura_file}: {e}")
             return None
 
+    def _download_invoice(self, fattura: Dict, type_dir: Path, tipo_fatture: str, client_id: str) -> DownloadResult:
+        """Scarica fattura e metadati di una voce della lista; eseguito nei thread di download_invoices_by_type."""
+        try:
+            fattura_file = fattura['tipoInvio'] + fattura['idFattura']
+            result = DownloadResult(success=True, file_type=tipo_fatture, client_id=client_id)
+
+            main_file = self.download_invoice_file(fattura_file, "fattura", type_dir)
+            if main_file:
+                result.file_path = main_file
+                meta_file = self.download_invoice_file(fattura_file, "metadati", type_dir)
+                if meta_file:
+                    result.metadata_path = meta_file
+            else:
+                result.success = False
+                result.error_message = "Download fallito"
+
+            return result
+
+        except Exception as e:
+            return DownloadResult(
+                success=False, error_message=str(e), file_type=tipo_fatture, client_id=client_id
+            )
+
     def download_invoices_by_type(self, tipo_fatture: str, data_inizio: str, data_fine: str, 
-                                 client_id: str, client_data: Dict) -> List[DownloadResult]:
+                                 client_id: str, client_data: Dict,
+                                 executor: Optional[ThreadPoolExecutor] = None) -> List[DownloadResult]:
+        """Scarica le fatture di un tipo; executor permette di condividere il pool di download tra più tipi."""
         results = []
 
         try:
@@ -1462,31 +2187,21 @@ class CompleteAdeDownloader:
 
             self.logger.info(f"Trovate {len(fatture)} fatture {tipo_fatture}")
 
+            # Creata da download_invoice_file al primo file scaricato
             type_dir = self.temp_dir / f"{tipo_fatture}_{client_id}"
-            type_dir.mkdir(parents=True, exist_ok=True)
-
-            with tqdm(fatture, desc=f"Download {tipo_fatture}") as pbar:
-                for fattura in pbar:
-                    try:
-                        fattura_file = fattura['tipoInvio'] + fattura['idFattura']
-                        result = DownloadResult(success=True, file_type=tipo_fatture, client_id=client_id)
-
-                        main_file = self.download_invoice_file(fattura_file, "fattura", type_dir)
-                        if main_file:
-                            result.file_path = main_file
-                            meta_file = self.download_invoice_file(fattura_file, "metadati", type_dir)
-                            if meta_file:
-                                result.metadata_path = meta_file
-                        else:
-                            result.success = False
-                            result.error_message = "Download fallito"
 
-                        results.append(result)
-
-                    except Exception as e:
-                        results.append(DownloadResult(
-                            success=False, error_message=str(e), file_type=tipo_fatture, client_id=client_id
-                        ))
+            # Download concorrenti sulla stessa sessione (cookie e token condivisi); risultati nell'ordine della lista
+            own_executor = executor is None
+            if own_executor:
+                executor = ThreadPoolExecutor(max_workers=self.max_parallel_downloads)
+            try:
+                # Lista costruita in un colpo solo dall'iteratore dei risultati; la barra avanza a ogni risultato
+                results = list(tqdm(executor.map(self._download_invoice, fatture, repeat(type_dir),
+                                                 repeat(tipo_fatture), repeat(client_id)),
+                                    total=len(fatture), desc=f"Download {tipo_fatture}"))
+            finally:
+                if own_executor:
+                    executor.shutdown()
 
             return results
 
@@ -1495,6 +2210,14 @@ class CompleteAdeDownloader:
 
     def download_client_invoices(self, client_id: str, client_data: Dict, 
                                 data_inizio: str, data_fine: str) -> List[DownloadResult]:
+        return self.download_client_periods(client_id, client_data, [(data_inizio, data_fine)])
+
+    def download_client_periods(self, client_id: str, client_data: Dict,
+                                periodi: List[Tuple[str, str]]) -> List[DownloadResult]:
+        """Scarica più periodi di un cliente con una sola selezione del profilo.
+        
+        Il profilo scelto vale per tutta la sessione AdE: i clienti restano in sequenza,
+        mentre periodi e tipi dello stesso cliente procedono in parallelo."""
         all_results = []
 
         try:
@@ -1504,19 +2227,19 @@ class CompleteAdeDownloader:
             if not self.setup_service_headers():
                 return [DownloadResult(success=False, error_message="Setup headers fallito", client_id=client_id)]
 
-            tipi_docs = self.download_config.get('tipi_documenti', {})
-
-            if tipi_docs.get('fatture_emesse', True):
-                results = self.download_invoices_by_type('emesse', data_inizio, data_fine, client_id, client_data)
-                all_results.extend(results)
+            jobs = [(data_inizio, data_fine, tipo) for data_inizio, data_fine in periodi for tipo in self.tipi_download]
+            if not jobs:
+                return all_results
 
-            if tipi_docs.get('fatture_ricevute', True):
-                results = self.download_invoices_by_type('ricevute_ricezione', data_inizio, data_fine, client_id, client_data)
-                all_results.extend(results)
-
-            if tipi_docs.get('fatture_passive', True):
-                results = self.download_invoices_by_type('passive', data_inizio, data_fine, client_id, client_data)
-                all_results.extend(results)
+            # Liste e download di periodi e tipi in parallelo; un solo pool limita i download contemporanei del cliente
+            with ThreadPoolExecutor(max_workers=self.max_parallel_downloads) as downloads, \
+                    ThreadPoolExecutor(max_workers=min(len(jobs), self.max_parallel_downloads)) as per_tipo:
+                futures = [per_tipo.submit(self.download_invoices_by_type, tipo, data_inizio, data_fine,
+                                           client_id, client_data, downloads)
+                           for data_inizio, data_fine, tipo in jobs]
+                # Risultati nell'ordine periodo -> tipo, come nel ciclo sequenziale
+                for future in futures:
+                    all_results.extend(future.result())
 
             return all_results
 
@@ -1559,33 +2282,40 @@ class AdvancedIntegratedSystem:
             decoder = AdvancedP7MDecoder(self.logger)
             total_decoded = 0
             errors = []
-            method_stats = {}
-
-            p7m_files = list(source_dir.glob("**/*.p7m"))
-            
-            if not p7m_files:
-                return {
-                    'success': True, 
-                    'decoded_files': 0, 
-                    'errors': [],
-                    'method_statistics': {}
-                }
-
-            with tqdm(p7m_files, desc="Decodifica P7M Avanzata") as pbar:
-                for p7m_file in pbar:
+            method_stats = Counter()
+
+            # Ricerca dei file non materializzata: la decodifica parte dal primo file trovato
+            p7m_jobs = ((p7m_file, p7m_file.parent / "decoded_advanced") for p7m_file in source_dir.glob("**/*.p7m"))
+            processed = 0
+
+            # Ridisegno della barra limitato: su lotti grandi i refresh del terminale costano più dei file piccoli
+            with tqdm(desc="Decodifica P7M Avanzata", mininterval=0.5) as pbar:
+                # Decodifica su un pool di processi: un decoder per worker, statistiche riunite nel decoder locale
+                for i, (p7m_file, decode_result) in enumerate(decoder.decrypt_p7m_iter(p7m_jobs)):
+                    processed += 1
+                    pbar.update()
                     try:
-                        output_dir = p7m_file.parent / "decoded_advanced"
-                        success, decoded_file, decode_errors, method = decoder.decrypt_p7m_file(p7m_file, output_dir)
+                        success, decoded_file, decode_errors, method = decode_result
                         
                         if success:
                             total_decoded += 1
-                            method_stats[method] = method_stats.get(method, 0) + 1
-                            pbar.set_postfix({"Metodo": method, "Successi": total_decoded})
+                            method_stats[method] += 1
+                            if i % PROGRESS_UPDATE_EVERY == 0:
+                                pbar.set_postfix({"Metodo": method, "Successi": total_decoded}, refresh=False)
                         else:
                             errors.extend(decode_errors[:2])  # Limita errori per file
                             
                     except Exception as e:
                         errors.append(f"Errore {p7m_file.name}: {str(e)}")
+                pbar.set_postfix({"Successi": total_decoded}, refresh=False)
+
+            if not processed:
+                return {
+                    'success': True, 
+                    'decoded_files': 0, 
+                    'errors': [],
+                    'method_statistics': {}
+                }
 
             # Ottieni statistiche complete dal decoder
             decoder_stats = decoder.get_statistics()
@@ -1615,35 +2345,18 @@ class AdvancedIntegratedSystem:
                 return result
             
             # Trova tutti i file supportati
-            all_files = []
-            for ext in SUPPORTED_EXTENSIONS:
-                all_files.extend(source_dir.glob(f"**/*{ext}"))
+            all_files = find_supported_files(source_dir)
             
             result = OrganizationResult(success=True)
             
-            with tqdm(all_files, desc="Riorganizzazione Avanzata", unit="file") as pbar:
-                for file_path in pbar:
+            with tqdm(all_files, desc="Riorganizzazione Avanzata", unit="file", mininterval=0.5,
+                      miniters=max(1, len(all_files) // 200)) as pbar:
+                for i, file_path in enumerate(pbar):
                     try:
-                        # Processa con sistema avanzato
-                        proc_result, parsed_data = self.organizer.process_single_file_advanced(file_path)
+                        # Processa con sistema avanzato: l'XML estratto viene riusato per il salvataggio
+                        proc_result, parsed_data, xml_content = self.organizer.process_single_file_advanced(file_path)
                         
                         if proc_result.status == "OK" and parsed_data:
-                            # Estrae XML per salvataggio
-                            xml_content = ""
-                            if file_path.suffix.lower() == '.xml':
-                                xml_content = file_path.read_text(encoding='utf-8', errors='ignore')
-                            elif file_path.suffix.lower() == '.p7m':
-                                # Decodifica per ottenere XML
-                                temp_dir = file_path.parent / 'temp_decode_org'
-                                success, decoded_file, _, _ = self.organizer.decoder.decrypt_p7m_file(file_path, temp_dir)
-                                if success and decoded_file and decoded_file.exists():
-                                    xml_content = decoded_file.read_text(encoding='utf-8', errors='ignore')
-                                    # Cleanup
-                                    try:
-                                        shutil.rmtree(temp_dir)
-                                    except:
-                                        pass
-                            
                             # Salva organizzato
                             success = self.organizer.save_organized_file_advanced(
                                 file_path, xml_content, parsed_data, proc_result, "Cliente_Riorganizzato"
@@ -1653,7 +2366,7 @@ class AdvancedIntegratedSystem:
                                 result.organized_files += 1
                                 # Aggiorna statistiche
                                 if proc_result.method_used != "NONE":
-                                    result.decoding_stats[proc_result.method_used] = result.decoding_stats.get(proc_result.method_used, 0) + 1
+                                    result.decoding_stats[proc_result.method_used] += 1
                             else:
                                 result.errors.append(f"Errore salvataggio {file_path.name}")
                         else:
@@ -1661,13 +2374,18 @@ class AdvancedIntegratedSystem:
                                 continue  # Non è un errore
                             result.errors.append(f"Errore elaborazione {file_path.name}: {proc_result.error_message}")
                         
-                        pbar.set_postfix({
-                            "Elaborati": result.organized_files,
-                            "Errori": len(result.errors)
-                        })
+                        if i % PROGRESS_UPDATE_EVERY == 0:
+                            pbar.set_postfix({
+                                "Elaborati": result.organized_files,
+                                "Errori": len(result.errors)
+                            }, refresh=False)
                         
                     except Exception as e:
                         result.errors.append(f"Errore {file_path.name}: {str(e)}")
+                pbar.set_postfix({"Elaborati": result.organized_files, "Errori": len(result.errors)}, refresh=False)
+            
+            self.organizer.close_metadata_logs()
+            self.organizer.save_manifest()
             
             # Aggiungi statistiche complete
             processing_stats = self.organizer.get_processing_statistics()
@@ -1691,16 +2409,13 @@ class AdvancedIntegratedSystem:
             trimestri = divide_in_trimestri(data_inizio, data_fine)
             active_clients = self.config_manager.get_active_clients()
 
-            for trimestre in trimestri:
-                inizio, fine = trimestre
+            for inizio, fine in trimestri:
                 self.logger.info(f"📅 Trimestre: {inizio} - {fine}")
 
-                for client_id, client_data in active_clients.items():
-                    results = self.downloader.download_client_invoices(client_id, client_data, inizio, fine)
-
-                    if client_id not in all_results:
-                        all_results[client_id] = []
-                    all_results[client_id].extend(results)
+            # Un cliente alla volta (il profilo AdE è legato alla sessione), tutti i suoi trimestri in parallelo
+            for client_id, client_data in active_clients.items():
+                results = self.downloader.download_client_periods(client_id, client_data, trimestri)
+                all_results.setdefault(client_id, []).extend(results)
 
             return all_results
 
@@ -1745,32 +2460,38 @@ def generate_advanced_report(results: List[AdvancedProcessingResult],
                            processing_stats: Dict) -> str:
     """Genera report avanzato con statistiche dettagliate."""
     total = len(results)
-    ok_count = sum(1 for r in results if r.status == "OK")
-    ko_count = sum(1 for r in results if r.status == "KO")
-    skip_count = sum(1 for r in results if r.status == "SKIPPED")
+    ok_count = ko_count = skip_count = 0
+    type_stats = Counter()
+    method_stats = Counter()
+    fatture_con_ritenuta = 0
+    totale_ritenute = 0
+    total_original_size = total_decoded_size = 0
+    companies = set()
+    years = set()
     
-    # Statistiche per tipo file
-    type_stats = {}
+    # Un solo passaggio sui risultati per tutte le statistiche (esiti, tipi, decodifica, ritenute, dimensioni)
     for r in results:
+        status = r.status
+        if status == "OK":
+            ok_count += 1
+        elif status == "KO":
+            ko_count += 1
+        elif status == "SKIPPED":
+            skip_count += 1
         if r.file_type:
-            type_stats[r.file_type] = type_stats.get(r.file_type, 0) + 1
-    
-    # Statistiche decodifica
-    method_stats = {}
-    for r in results:
+            type_stats[r.file_type] += 1
         if r.method_used != "NONE":
-            method_stats[r.method_used] = method_stats.get(r.method_used, 0) + 1
-    
-    # Statistiche ritenute
-    fatture_con_ritenuta = sum(1 for r in results if r.has_ritenuta)
-    totale_ritenute = sum(r.importo_ritenuta for r in results if r.has_ritenuta)
-    
-    # Statistiche dimensioni
-    total_original_size = sum(r.original_size for r in results if r.original_size > 0)
-    total_decoded_size = sum(r.decoded_size for r in results if r.decoded_size > 0)
-    
-    companies = set(r.company_name for r in results if r.company_name)
-    years = set(r.invoice_year for r in results if r.invoice_year)
+            method_stats[r.method_used] += 1
+        if r.has_ritenuta:
+            fatture_con_ritenuta += 1
+            totale_ritenute += r.importo_ritenuta
+        # Dimensioni mai negative (default 0): somma diretta senza confronti
+        total_original_size += r.original_size
+        total_decoded_size += r.decoded_size
+        if r.company_name:
+            companies.add(r.company_name)
+        if r.invoice_year:
+            years.add(r.invoice_year)
     
     report = [
         f"\n{'='*80}",
@@ -1780,10 +2501,12 @@ def generate_advanced_report(results: List[AdvancedProcessingResult],
         f"  • File totali: {total}",
         f"  • Elaborati OK: {ok_count}",
         f"  • Errori: {ko_count}",
-        f"  • Saltati: {skip_count}",
-        f"  • Tasso successo: {(ok_count/total*100):.1f}%" if total > 0 else "",
-        f"\n📁 STATISTICHE TIPI FILE:"
+        f"  • Saltati: {skip_count}"
     ]
+    # Righe facoltative aggiunte solo se significative: niente righe vuote nel report
+    if total > 0:
+        report.append(f"  • Tasso successo: {(ok_count/total*100):.1f}%")
+    report.append(f"\n📁 STATISTICHE TIPI FILE:")
     
     for file_type, count in type_stats.items():
         report.append(f"  • {file_type}: {count}")
@@ -1803,19 +2526,24 @@ def generate_advanced_report(results: List[AdvancedProcessingResult],
                 f"  • ASN1 successi: {decoder_stats.get('ASN1_SUCCESS', 0)}",
                 f"  • Windows API successi: {decoder_stats.get('WINDOWS_API_SUCCESS', 0)}",
                 f"  • OpenSSL successi: {decoder_stats.get('OPENSSL_SUCCESS', 0)}",
+                f"  • Da cache: {decoder_stats.get('CACHE_HIT', 0)}",
                 f"  • Fallimenti: {decoder_stats.get('FAILED', 0)}"
             ])
     
     report.extend([
         f"\n💰 RITENUTE:",
         f"  • Fatture con ritenuta: {fatture_con_ritenuta}",
-        f"  • Totale ritenute: EUR{totale_ritenute:.2f}",
-        f"  • Media ritenuta: EUR{(totale_ritenute/fatture_con_ritenuta):.2f}" if fatture_con_ritenuta > 0 else "",
+        f"  • Totale ritenute: EUR{totale_ritenute:.2f}"
+    ])
+    if fatture_con_ritenuta > 0:
+        report.append(f"  • Media ritenuta: EUR{(totale_ritenute/fatture_con_ritenuta):.2f}")
+    report.extend([
         f"\n📏 DIMENSIONI:",
         f"  • Dimensione totale originale: {total_original_size/1024/1024:.1f} MB",
-        f"  • Dimensione totale decodificata: {total_decoded_size/1024/1024:.1f} MB",
-        f"  • Rapporto compressione: {(total_decoded_size/total_original_size*100):.1f}%" if total_original_size > 0 else ""
+        f"  • Dimensione totale decodificata: {total_decoded_size/1024/1024:.1f} MB"
     ])
+    if total_original_size > 0:
+        report.append(f"  • Rapporto compressione: {(total_decoded_size/total_original_size*100):.1f}%")
     
     if companies:
         report.append(f"\nAZIENDE: {', '.join(companies)}")
@@ -1877,6 +2605,23 @@ def validate_date_format(date_str: str) -> bool:
     except ValueError:
         return False
 
+def print_lines(lines: Iterable[str]):
+    """Stampa un blocco di righe con una sola scrittura; nulla se il blocco è vuoto."""
+    text = "\n".join(lines)
+    if text:
+        print(text)
+
+def print_created_folders(folders_by_client: Dict[str, List[str]], client_names: Optional[Dict[str, Dict]] = None):
+    """Riepilogo delle cartelle create: al più tre per cliente, senza copie delle liste."""
+    lines = []
+    for client_id, folders in folders_by_client.items():
+        client_name = client_names.get(client_id, {}).get('nome_azienda', client_id) if client_names is not None else client_id
+        lines.append(f"  👤 {client_name}:")
+        lines.extend(f"    📂 {folder}" for folder in islice(folders, 3))
+        if len(folders) > 3:
+            lines.append(f"    📂 ... e altre {len(folders)-3} cartelle")
+    print_lines(lines)
+
 def show_config_template():
     print("\n📋 TEMPLATE CONFIGURAZIONE AVANZATA:")
     template = {
@@ -2030,9 +2775,7 @@ def main():
                     print(f"✅ Decodifica completata: {decoded_count} file")
                     
                     if args.stats and method_stats:
-                        print("📊 Statistiche Decodifica:")
-                        for method, count in method_stats.items():
-                            print(f"    {method}: {count}")
+                        print_lines(["📊 Statistiche Decodifica:"] + [f"    {method}: {count}" for method, count in method_stats.items()])
                 else:
                     print(f"❌ Decodifica fallita: {decode_results.get('error', 'Errore sconosciuto')}")
                     success = False
@@ -2052,19 +2795,13 @@ def main():
                     print(f"✅ Organizzazione completata: {org_results.organized_files} file")
                     
                     if args.stats and org_results.decoding_stats:
-                        print("📊 Statistiche Organizzazione:")
-                        for method, count in org_results.decoding_stats.items():
-                            print(f"    {method}: {count}")
+                        print_lines(["📊 Statistiche Organizzazione:"] + [f"    {method}: {count}" for method, count in org_results.decoding_stats.items()])
                     
                     if org_results.client_folders_created:
                         print(f"\n📁 STRUTTURA CREATA:")
-                        for client_id, folders in org_results.client_folders_created.items():
-                            client_name = system.config_manager.get_active_clients().get(client_id, {}).get('nome_azienda', client_id)
-                            print(f"  👤 {client_name}:")
-                            for folder in folders[:3]:
-                                print(f"    📂 {folder}")
-                            if len(folders) > 3:
-                                print(f"    📂 ... e altre {len(folders)-3} cartelle")
+                        # Filtro dei clienti attivi calcolato una volta sola, non per ogni cliente stampato
+                        print_created_folders(org_results.client_folders_created,
+                                              system.config_manager.get_active_clients())
                 else:
                     print(f"❌ Organizzazione fallita: {len(org_results.errors)} errori")
                     success = False
@@ -2080,9 +2817,7 @@ def main():
                     print("\n📈 STATISTICHE COMPLETE:")
                     if processing_stats.get('decoder'):
                         decoder_stats = processing_stats['decoder']
-                        print("🔓 Decoder:")
-                        for method, count in decoder_stats.items():
-                            print(f"    {method}: {count}")
+                        print_lines(["🔓 Decoder:"] + [f"    {method}: {count}" for method, count in decoder_stats.items()])
                     
                     if processing_stats.get('duplicates'):
                         dup_stats = processing_stats['duplicates']
@@ -2110,14 +2845,13 @@ def main():
                 # Mostra errori specifici
                 all_errors = []
                 if 'decode_results' in result and 'errors' in result['decode_results']:
-                    all_errors.extend(result['decode_results']['errors'][:3])
+                    all_errors.extend(islice(result['decode_results']['errors'], 3))
                 if 'organization_results' in result:
-                    all_errors.extend(result['organization_results'].errors[:3])
+                    all_errors.extend(islice(result['organization_results'].errors, 3))
                 
                 if all_errors:
                     print("📝 Errori principali:")
-                    for error in all_errors:
-                        print(f"  ❗ {error}")
+                    print_lines(f"  ❗ {error}" for error in all_errors)
 
         elif args.command == 'decode-advanced':
             source_dir = Path(args.source) if args.source else None
@@ -2135,15 +2869,11 @@ def main():
                 print(f"✅ Decodifica completata: {decoded_count} file, {errors_count} errori")
                 
                 if args.stats and method_stats:
-                    print("\n📊 STATISTICHE METODI:")
-                    for method, count in method_stats.items():
-                        print(f"  {method}: {count}")
+                    print_lines(["\n📊 STATISTICHE METODI:"] + [f"  {method}: {count}" for method, count in method_stats.items()])
                     
                     file_distribution = result.get('file_method_distribution', {})
                     if file_distribution:
-                        print("\n📈 DISTRIBUZIONE PER FILE:")
-                        for method, count in file_distribution.items():
-                            print(f"  {method}: {count} file")
+                        print_lines(["\n📈 DISTRIBUZIONE PER FILE:"] + [f"  {method}: {count} file" for method, count in file_distribution.items()])
                         
             else:
                 print(f"❌ Decodifica fallita: {result.get('error', 'Errore sconosciuto')}")
@@ -2163,22 +2893,14 @@ def main():
                 print(f"✅ Riorganizzazione completata: {result.organized_files} file")
                 
                 if args.stats and result.decoding_stats:
-                    print("\n📊 STATISTICHE DECODIFICA:")
-                    for method, count in result.decoding_stats.items():
-                        print(f"  {method}: {count}")
+                    print_lines(["\n📊 STATISTICHE DECODIFICA:"] + [f"  {method}: {count}" for method, count in result.decoding_stats.items()])
                 
                 if result.client_folders_created:
                     print(f"\n📁 STRUTTURA CREATA:")
-                    for client_id, folders in result.client_folders_created.items():
-                        print(f"  👤 {client_id}:")
-                        for folder in folders[:3]:
-                            print(f"    📂 {folder}")
-                        if len(folders) > 3:
-                            print(f"    📂 ... e altre {len(folders)-3} cartelle")
+                    print_created_folders(result.client_folders_created)
             else:
                 print("❌ Riorganizzazione fallita")
-                for error in result.errors[:5]:
-                    print(f"  💥 {error}")
+                print_lines(f"  💥 {error}" for error in islice(result.errors, 5))
 
     except KeyboardInterrupt:
         print("\n⏹️ Interrotto dall'utente")
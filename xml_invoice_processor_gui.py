@@ -3,9 +3,29 @@ from tkinter import ttk
 from tkinter import filedialog
 from tkcalendar import DateEntry
 from datetime import datetime
+from contextlib import redirect_stderr, redirect_stdout
+import importlib
+import io
+import queue
+import shutil
 import subprocess
+import sys
+import threading
 import os
-import urllib.request
+
+# Intervallo (ms) con cui la GUI raccoglie l'output dell'elaborazione e aggiorna il log
+OUTPUT_POLL_MS = 50
+# Righe massime conservate nel log: oltre, le più vecchie vengono eliminate
+OUTPUT_MAX_LINES = 10000
+
+class QueueWriter(io.TextIOBase):
+    """Flusso di testo che accoda l'output del processore; la GUI lo legge dal thread principale."""
+    def __init__(self, output_queue):
+        self.output_queue = output_queue
+
+    def write(self, text):
+        self.output_queue.put(text)
+        return len(text)
 
 class InvoiceProcessorGUI:
     def __init__(self, root):
@@ -108,12 +128,21 @@ class InvoiceProcessorGUI:
         y_scroll.config(command=self.output_text.yview)
         x_scroll.config(command=self.output_text.xview)
 
+        # Un tag per colore, creato una volta sola; i messaggi sono scritti a blocchi da flush_log
+        for color in ("green", "red", "blue", "orange"):
+            self.output_text.tag_configure(color, foreground=color)
+        self.log_buffer = []
+        self.log_flush_pending = False
+
         # Variabile per il percorso del file PDF generato
         self.pdf_path = None
 
         # Controllo dell'esistenza del file processore
         self.check_processor_file()
 
+        # Processore importato una volta sola: ogni elaborazione evita l'avvio di un nuovo interprete
+        self.processor = self.load_processor()
+
     def browse_folder(self):
         folder_selected = filedialog.askdirectory()
         self.folder_path.set(folder_selected)
@@ -123,26 +152,59 @@ class InvoiceProcessorGUI:
         if not os.path.exists(processor_path):
             self.log_output("File 'xml_fatture_processor.py' non trovato. Scaricamento in corso...\n", "orange")
             try:
+                # Importato solo quando serve scaricare: di norma il file c'è già e SSL non viene caricato
+                import urllib.request
                 url = "https://raw.githubusercontent.com/socrat3/XMLFATTUREPROCESSOR/main/xml_fatture_processor.py"
-                urllib.request.urlretrieve(url, processor_path)
+                # Scaricato in un file temporaneo e installato solo se è codice Python valido:
+                # un download interrotto o una pagina d'errore non restano come processore "presente"
+                temp_path = processor_path + ".download"
+                try:
+                    # Copia a blocchi da 1 MiB invece degli 8 KB di urlretrieve
+                    with urllib.request.urlopen(url) as response, open(temp_path, "wb") as f:
+                        shutil.copyfileobj(response, f, length=1 << 20)
+                    with open(temp_path, "rb") as f:
+                        compile(f.read(), processor_path, "exec")
+                    os.replace(temp_path, processor_path)
+                finally:
+                    if os.path.exists(temp_path):
+                        os.remove(temp_path)
                 self.log_output("File 'xml_fatture_processor.py' scaricato con successo!\n", "green")
             except Exception as e:
                 self.log_output(f"Errore durante il download: {str(e)}\n", "red")
 
+    def load_processor(self):
+        # Il processore è cercato nella directory corrente, come con l'esecuzione in un processo separato
+        if os.getcwd() not in sys.path:
+            sys.path.insert(0, os.getcwd())
+        try:
+            return importlib.import_module("xml_fatture_processor")
+        except Exception as e:
+            self.log_output(f"Processore non importabile ({str(e)}): verrà eseguito in un processo separato\n", "orange")
+            return None
+
     def process_invoices(self):
+        # F5 resta attivo anche con il pulsante disabilitato: niente elaborazioni sovrapposte
+        if str(self.process_button['state']) == 'disabled':
+            return
+
         folder = self.folder_path.get()
         start_date = self.start_date.get_date().strftime('%d/%m/%Y')
         end_date = self.end_date.get_date().strftime('%d/%m/%Y')
         supplier_vat = self.supplier_vat.get()
         client_vat = self.client_vat.get()
-        option_r = "-R" if self.option_r.get() else ""
-        option_m = "-M" if self.option_m.get() else ""
 
         if not folder:
             self.log_output("Seleziona prima una cartella!\n", "red")
             return
 
-        command = ["python", "xml_fatture_processor.py", folder, option_r, option_m]
+        # Solo le opzioni selezionate: niente argomenti vuoti da scartare nel processore.
+        # Il processo separato, se serve, usa lo stesso interprete della GUI
+        # -V: l'output della GUI non è un terminale, ma la tabella delle fatture va mostrata
+        command = [sys.executable, "xml_fatture_processor.py", folder, "-V"]
+        if self.option_r.get():
+            command.append("-R")
+        if self.option_m.get():
+            command.append("-M")
         if supplier_vat:
             command += ["-FORNITORE", supplier_vat]
         if client_vat:
@@ -151,37 +213,129 @@ class InvoiceProcessorGUI:
 
         self.log_output(f"Eseguendo comando: {' '.join(command)}\n", "blue")
         self.process_button.config(state='disabled')
-        self.root.after(100, lambda: self.run_processing(command))
+        # Il lavoro parte subito in un thread: il ciclo di Tk non resta mai bloccato
+        self.run_processing(command)
 
     def run_processing(self, command):
+        # Elaborazione in un thread (nello stesso processo o, in mancanza del modulo, in un processo separato):
+        # l'output arriva alla GUI man mano
+        output_queue = queue.Queue()
+        self.exit_code = 0
+        if self.processor is not None:
+            worker = threading.Thread(target=self.run_processor_main, args=(command[2:], output_queue), daemon=True)
+        else:
+            worker = threading.Thread(target=self.run_processor_subprocess, args=(command, output_queue), daemon=True)
+        worker.start()
+        self.root.after(OUTPUT_POLL_MS, self.poll_output, worker, output_queue, "")
+
+    def run_processor_main(self, argv, output_queue):
+        # Anche stderr (messaggi di argparse) finisce nella finestra invece che sulla console
+        writer = QueueWriter(output_queue)
+        with redirect_stdout(writer), redirect_stderr(writer):
+            try:
+                self.exit_code = self.processor.main(argv) or 0
+            except SystemExit as e:
+                # Errore di sintassi: il messaggio è già stato stampato
+                self.exit_code = e.code if isinstance(e.code, int) else int(e.code is not None)
+            except Exception as e:
+                print(f"Errore: {str(e)}")
+                self.exit_code = 1
+
+    def run_processor_subprocess(self, command, output_queue):
+        # Righe inoltrate appena il processo le scrive; stderr unito a stdout per non bloccare su una pipe piena
         try:
-            result = subprocess.run(command, capture_output=True, text=True, check=True)
-            self.log_output(result.stdout, "green")
-            for line in result.stdout.splitlines():
-                if line.startswith("File PDF generato:"):
-                    self.pdf_path = line.split(":", 1)[1].strip()
-                    self.open_pdf_button.config(state='normal')
-        except subprocess.CalledProcessError as e:
-            self.log_output(e.stderr, "red")
+            with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1) as process:
+                for line in process.stdout:
+                    output_queue.put(line)
+            self.exit_code = process.returncode
         except Exception as e:
-            self.log_output(f"Errore: {str(e)}\n", "red")
-        finally:
-            self.process_button.config(state='normal')
+            output_queue.put(f"Errore: {str(e)}\n")
+            self.exit_code = 1
+
+    def poll_output(self, worker, output_queue, partial_line):
+        # Stato del thread letto prima di svuotare la coda: nessun output perso alla fine
+        running = worker.is_alive()
+        new_chunks = []
+        while True:
+            try:
+                new_chunks.append(output_queue.get_nowait())
+            except queue.Empty:
+                break
+        if new_chunks:
+            # Un solo inserimento nel widget per tutto l'output accumulato dall'ultimo controllo
+            text = "".join(new_chunks)
+            self.log_output(text, "green")
+            # Solo le righe complete: l'ultima, se interrotta, si completa con l'output successivo
+            lines = (partial_line + text).split("\n")
+            partial_line = lines.pop()
+            self.find_pdf_path(lines)
+        if running:
+            self.root.after(OUTPUT_POLL_MS, self.poll_output, worker, output_queue, partial_line)
+            return
+        self.find_pdf_path([partial_line])
+        # Segnalato dopo l'ultimo output, così compare in fondo al log
+        if self.exit_code:
+            self.log_output(f"Elaborazione terminata con errori (codice {self.exit_code})\n", "red")
+        self.process_button.config(state='normal')
+
+    def find_pdf_path(self, lines):
+        for line in lines:
+            if line.startswith("File PDF generato:"):
+                self.pdf_path = line.split(":", 1)[1].strip()
+                self.open_pdf_button.config(state='normal')
 
     def log_output(self, message, color):
+        # Messaggi accumulati e scritti insieme ogni 50 ms: un solo aggiornamento del widget per blocco
+        self.log_buffer.append((message, color))
+        if not self.log_flush_pending:
+            self.log_flush_pending = True
+            self.root.after(OUTPUT_POLL_MS, self.flush_log)
+
+    def flush_log(self):
+        self.log_flush_pending = False
+        if not self.log_buffer:
+            return
+        # Messaggi consecutivi dello stesso colore uniti in un solo segmento
+        segments = []
+        for message, color in self.log_buffer:
+            if segments and segments[-1][1] == color:
+                segments[-1][0].append(message)
+            else:
+                segments.append(([message], color))
+        self.log_buffer = []
+        chunks = []
+        for messages, color in segments:
+            chunks += ["".join(messages), color]
         self.output_text.config(state=tk.NORMAL)
-        self.output_text.insert(tk.END, message)
+        self.output_text.insert(tk.END, *chunks)
+        # Log limitato alle ultime OUTPUT_MAX_LINES righe, con una sola cancellazione per blocco
+        line_count = int(self.output_text.index("end-1c").split(".")[0])
+        if line_count > OUTPUT_MAX_LINES:
+            self.output_text.delete("1.0", f"{line_count - OUTPUT_MAX_LINES + 1}.0")
         self.output_text.config(state=tk.DISABLED)
+        self.output_text.see(tk.END)
 
     def open_pdf(self):
         if self.pdf_path and os.path.exists(self.pdf_path):
+            if sys.platform == "win32":
+                # os.startfile può attendere la risoluzione dell'associazione del file: in un thread
+                threading.Thread(target=self.start_pdf_viewer, args=(self.pdf_path,), daemon=True).start()
+                return
+            # Su macOS e Linux il visualizzatore parte come processo separato, senza attesa
+            viewer = "open" if sys.platform == "darwin" else "xdg-open"
             try:
-                os.startfile(self.pdf_path)
+                subprocess.Popen([viewer, self.pdf_path])
             except Exception as e:
                 self.log_output(f"Errore durante l'apertura del PDF: {str(e)}\n", "red")
         else:
             self.log_output("File PDF non trovato!\n", "red")
 
+    def start_pdf_viewer(self, pdf_path):
+        try:
+            os.startfile(pdf_path)
+        except Exception as e:
+            self.root.after(0, self.log_output, f"Errore durante l'apertura del PDF: {str(e)}\n", "red")
+
     def clear_fields(self):
         self.folder_path.set("")
         self.supplier_vat.set("")
@@ -190,6 +344,7 @@ class InvoiceProcessorGUI:
         self.end_date.set_date(datetime(2024, 12, 31))
         self.option_r.set(False)
         self.option_m.set(False)
+        self.log_buffer = []
         self.output_text.config(state=tk.NORMAL)
         self.output_text.delete(1.0, tk.END)
         self.output_text.config(state=tk.DISABLED)